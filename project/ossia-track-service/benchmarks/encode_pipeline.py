@@ -0,0 +1,365 @@
+"""
+Benchmark of track encoding pipeline.
+
+Generates synthetic WAV/FLAC fixtures with ffmpeg and runs FFMpegEncoder
+against them with in-memory database and local directory standing in for S3.
+Every case is run in its own process, so peak RSS is not shared between cases.
+Results are printed (or written to --output) as JSON.
+Encoder settings are read from environment as by the service itself,
+e.g. ENCODE_SINGLE_PASS=false benchmarks per-rendition processes.
+
+Run from the service directory:
+    python -m benchmarks.encode_pipeline --durations 30 180 --modes file stream
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import itertools
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections.abc import AsyncIterator
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Self
+
+import orjson
+
+# Config is read on import of service modules, none of these are used here
+for _key, _value in {
+    'SERVICE_PORT': '8000',
+    'SECURE': 'false',
+    'RABBIT_HOST': 'localhost',
+    'RABBIT_PORT': '5672',
+    'RABBIT_USER': 'benchmark',
+    'RABBIT_PASSWORD': 'benchmark',
+    'S3_HOST': 'localhost',
+    'S3_PORT': '9000',
+    'S3_ACCESS_KEY': 'benchmark',
+    'S3_SECRET_KEY': 'benchmark',
+    'POSTGRES_HOST': 'localhost',
+    'POSTGRES_PORT': '5432',
+    'POSTGRES_USER': 'benchmark',
+    'POSTGRES_PASSWORD': 'benchmark',
+    'POSTGRES_DB': 'benchmark',
+}.items():
+    os.environ.setdefault(_key, _value)
+
+FIXTURE_CMD = (
+    'ffmpeg -loglevel -8 -y '
+    '-f lavfi -i anoisesrc=color=pink:amplitude=0.2:r={rate}:d={duration} '
+    '-f lavfi -i sine=frequency=220:r={rate}:d={duration} '
+    '-filter_complex amix=inputs=2 -ac {channels} -ar {rate} {codec} {path}'
+)
+FIXTURE_CODECS = {'wav': '-c:a pcm_s16le -f wav', 'flac': '-c:a flac -f flac'}
+
+
+@dataclasses.dataclass(frozen=True)
+class Case:
+    duration: int
+    sample_rate: int
+    channels: int
+    format: str
+    mode: str
+
+    @property
+    def fixture_name(self) -> str:
+        return f'{self.duration}s_{self.sample_rate}_{self.channels}ch.{self.format}'
+
+
+class LocalBody:
+    """
+    Minimal StreamingBody over a local file
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    async def iter_chunks(self, chunk_size: int) -> AsyncIterator[bytes]:
+        with self.path.open('rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    async def read(self) -> bytes:
+        return self.path.read_bytes()
+
+
+class LocalPaginator:
+    def __init__(self, root: Path) -> None:
+        self.root = root
+
+    async def paginate(self, Bucket: str, Prefix: str) -> AsyncIterator[dict]:
+        bucket = self.root / Bucket
+        keys = [
+            path.relative_to(bucket).as_posix()
+            for path in bucket.rglob('*')
+            if path.is_file()
+        ]
+        yield {'Contents': [{'Key': key} for key in keys if key.startswith(Prefix)]}
+
+
+class LocalS3:
+    """
+    Stands in for S3 client, keeps objects in local directory
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self._uploads: dict[str, dict[int, bytes]] = {}
+
+    def _path(self, bucket: str, key: str) -> Path:
+        path = self.root / bucket / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def _etag(self, bucket: str, key: str) -> str:
+        stat = self._path(bucket, key).stat()
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        pass
+
+    async def upload_file(self, filename: str, Bucket: str, Key: str) -> None:
+        shutil.copyfile(filename, self._path(Bucket, Key))
+
+    async def put_object(
+        self, Bucket: str, Key: str, Body: bytes, **kwargs: Any
+    ) -> None:
+        self._path(Bucket, Key).write_bytes(Body)
+
+    async def get_object(self, Bucket: str, Key: str, Range: str | None = None) -> dict:
+        path = self._path(Bucket, Key)
+        if Range is None:
+            return {'Body': LocalBody(path)}
+        start, end = Range.removeprefix('bytes=').split('-')
+        with path.open('rb') as f:
+            f.seek(int(start))
+            data = f.read(int(end) - int(start) + 1)
+        part = path.with_name(f'{path.name}.range')
+        part.write_bytes(data)
+        return {'Body': LocalBody(part)}
+
+    async def head_object(self, Bucket: str, Key: str) -> dict:
+        return {'ETag': self._etag(Bucket, Key)}
+
+    async def delete_object(self, Bucket: str, Key: str) -> None:
+        self._path(Bucket, Key).unlink(missing_ok=True)
+
+    async def delete_objects(self, Bucket: str, Delete: dict) -> dict:
+        for obj in Delete['Objects']:
+            self._path(Bucket, obj['Key']).unlink(missing_ok=True)
+        return {}
+
+    def get_paginator(self, operation_name: str) -> LocalPaginator:
+        return LocalPaginator(self.root)
+
+    async def create_multipart_upload(self, Bucket: str, Key: str) -> dict:
+        upload_id = uuid.uuid4().hex
+        self._uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    async def upload_part(
+        self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes
+    ) -> dict:
+        self._uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"{PartNumber}"'}
+
+    async def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict
+    ) -> dict:
+        parts = self._uploads.pop(UploadId)
+        with self._path(Bucket, Key).open('wb') as f:
+            for part in MultipartUpload['Parts']:
+                f.write(parts[part['PartNumber']])
+        return {'ETag': self._etag(Bucket, Key)}
+
+    async def abort_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str
+    ) -> None:
+        self._uploads.pop(UploadId, None)
+
+
+def make_fixture(case: Case, directory: Path) -> Path:
+    path = directory / case.fixture_name
+    if not path.exists():
+        subprocess.run(
+            FIXTURE_CMD.format(
+                rate=case.sample_rate,
+                duration=case.duration,
+                channels=case.channels,
+                codec=FIXTURE_CODECS[case.format],
+                path=path,
+            ),
+            shell=True,
+            check=True,
+        )
+    return path
+
+
+def _dir_sizes(root: Path) -> dict[str, int]:
+    return {
+        bucket.name: sum(f.stat().st_size for f in bucket.rglob('*') if f.is_file())
+        for bucket in sorted(root.iterdir())
+        if bucket.is_dir() and bucket.name != 'buffer'
+    }
+
+
+async def _run_case(case: Case, fixture: Path, workdir: Path) -> dict[str, Any]:
+    from tortoise import Tortoise
+
+    from ossia.tracks.database.models import Creators, Tracks
+    from ossia.tracks.services import encode
+
+    s3 = LocalS3(workdir / 's3')
+    # Services open their own S3 clients, every one of them gets the local one
+    for name, module in list(sys.modules.items()):
+        if name.startswith('ossia.tracks.services.') and hasattr(module, 'S3Service'):
+            module.S3Service = lambda: s3  # type: ignore[attr-defined]
+
+    await Tortoise.init(
+        db_url='sqlite://:memory:', modules={'ossia': ['ossia.tracks.database.models']}
+    )
+    await Tortoise.generate_schemas()
+    try:
+        track_uuid, track_id = encode.FFMpegEncoder.generate_track_id()
+        creator = await Creators.create(display_name='benchmark', owner=uuid.uuid4())
+        await Tracks.create(id=track_uuid, title='benchmark', creator=creator)
+        media = await encode.FFMpegEncoder(track_id, file_path=str(fixture)).probe()
+
+        if case.mode == 'stream':
+            shutil.copyfile(fixture, s3._path('buffer', track_id))
+            encoder = encode.FFMpegEncoder(track_id, media=media)
+            job = encoder.process_stream(track_id)
+        else:
+            tmp = workdir / 'tmp'
+            tmp.mkdir()
+            shutil.copyfile(fixture, tmp / track_id)
+            encoder = encode.FFMpegEncoder(
+                track_id, tmp_path=str(tmp), file_path=str(tmp / track_id), media=media
+            )
+            job = encoder.process()
+
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        await job
+        wall_time = time.perf_counter() - start
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        await Tortoise.close_connections()
+
+    def cpu(before: resource.struct_rusage, after: resource.struct_rusage) -> float:
+        return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+    return {
+        **dataclasses.asdict(case),
+        'source_bytes': fixture.stat().st_size,
+        'wall_time': round(wall_time, 4),
+        'cpu_time': round(cpu(self_before, self_after), 4),
+        'encoder_cpu_time': round(cpu(children_before, children_after), 4),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': self_after.ru_maxrss,
+        'encoder_peak_rss_kb': children_after.ru_maxrss,
+        'bytes_written': _dir_sizes(workdir / 's3'),
+    }
+
+
+def _case_worker(case: Case, fixture: Path) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix='ossia-bench-') as workdir:
+        return asyncio.run(_run_case(case, fixture, Path(workdir)))
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--durations', type=int, nargs='+', default=[30, 180])
+    parser.add_argument('--sample-rates', type=int, nargs='+', default=[44100, 96000])
+    parser.add_argument('--channels', type=int, nargs='+', default=[2])
+    parser.add_argument(
+        '--formats', nargs='+', choices=FIXTURE_CODECS, default=['wav', 'flac']
+    )
+    parser.add_argument(
+        '--modes', nargs='+', choices=('file', 'stream'), default=['file', 'stream']
+    )
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument(
+        '--fixtures', type=Path, default=Path(tempfile.gettempdir()) / 'ossia-fixtures'
+    )
+    parser.add_argument('--output', type=Path, help='Write results to file')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    args.fixtures.mkdir(parents=True, exist_ok=True)
+
+    from ossia.tracks.config import TracksServiceConfig
+
+    config = TracksServiceConfig()
+    results = []
+    # Fresh interpreter per case, so ru_maxrss belongs to this case only
+    context = multiprocessing.get_context('spawn')
+    cases = itertools.product(
+        args.durations, args.sample_rates, args.channels, args.formats, args.modes
+    )
+    for params in cases:
+        case = Case(*params)
+        fixture = make_fixture(case, args.fixtures)
+        for _ in range(args.repeat):
+            with context.Pool(1) as pool:
+                result = pool.apply(_case_worker, (case, fixture))
+            print(
+                f'{case.fixture_name} {case.mode}: {result["wall_time"]}s wall, '
+                f'{result["encoder_cpu_time"]}s encoder CPU',
+                file=sys.stderr,
+            )
+            results.append(result)
+
+    report = orjson.dumps(
+        {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'config': {
+                'encode_single_pass': config.encode_single_pass,
+                'encode_fast_first': config.encode_fast_first,
+                'encode_slots': config.encode_slots,
+                'encode_niceness': config.encode_niceness,
+            },
+            'results': results,
+        },
+        option=orjson.OPT_INDENT_2,
+    )
+    if args.output is None:
+        sys.stdout.buffer.write(report + b'\n')
+    else:
+        args.output.write_bytes(report)
+
+
+if __name__ == '__main__':
+    main()
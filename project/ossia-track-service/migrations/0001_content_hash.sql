@@ -0,0 +1,4 @@
+-- Renditions are stored under audio_key and shared by tracks with same source
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "audio_key" VARCHAR(32);
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "content_hash" VARCHAR(64);
+CREATE INDEX IF NOT EXISTS "idx_tracks_content_1d1059" ON "tracks" ("content_hash");
@@ -0,0 +1,2 @@
+-- Ready tracks with empty list are served the whole legacy ladder
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "renditions" JSONB NOT NULL DEFAULT '[]';
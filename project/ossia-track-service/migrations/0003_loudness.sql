@@ -0,0 +1,6 @@
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "integrated_loudness" DOUBLE PRECISION;
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "loudness_range" DOUBLE PRECISION;
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "true_peak" DOUBLE PRECISION;
+ALTER TABLE "audiorenditions" ADD COLUMN IF NOT EXISTS "integrated_loudness" DOUBLE PRECISION;
+ALTER TABLE "audiorenditions" ADD COLUMN IF NOT EXISTS "loudness_range" DOUBLE PRECISION;
+ALTER TABLE "audiorenditions" ADD COLUMN IF NOT EXISTS "true_peak" DOUBLE PRECISION;
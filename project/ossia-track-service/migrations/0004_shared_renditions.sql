@@ -0,0 +1,2 @@
+-- Shared sources with empty list are linked to the whole legacy ladder
+ALTER TABLE "audiorenditions" ADD COLUMN IF NOT EXISTS "renditions" JSONB NOT NULL DEFAULT '[]';
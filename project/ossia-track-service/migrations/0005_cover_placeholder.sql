@@ -0,0 +1,3 @@
+-- Filled in when cover is processed again, placeholders are optional until then
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "cover_color" VARCHAR(7);
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "cover_blurhash" VARCHAR(64);
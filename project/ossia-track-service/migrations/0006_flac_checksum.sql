@@ -0,0 +1,3 @@
+-- Computed on first archive download of each track
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "flac_crc32" BIGINT;
+ALTER TABLE "tracks" ADD COLUMN IF NOT EXISTS "flac_etag" VARCHAR(64);
@@ -3,6 +3,8 @@ from ipaddress import IPv4Address
 from pydantic import AmqpDsn, HttpUrl, PostgresDsn, computed_field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from ossia.tracks.enum import DeliveryMode
+
 
 class TracksServiceConfig(BaseSettings):
     model_config = SettingsConfigDict(env_file='../.env', extra='ignore')
@@ -21,6 +23,11 @@ class TracksServiceConfig(BaseSettings):
     s3_port: int
     s3_access_key: str
     s3_secret_key: str
+    s3_public_url: str | None = None
+    s3_pool_size: int = 64
+    s3_keepalive_timeout: float = 30
+    s3_connect_timeout: float = 5
+    s3_read_timeout: float = 60
 
     postgres_host: IPv4Address | str
     postgres_port: int
@@ -28,6 +35,28 @@ class TracksServiceConfig(BaseSettings):
     postgres_password: str
     postgres_db: str
 
+    encode_single_pass: bool = True
+    encode_fast_first: bool = True
+    encode_streaming: bool = False
+    encode_opus: bool = False
+    encode_slots: int | None = None
+    encode_niceness: int = 10
+    encode_cpu_affinity: list[int] | None = None
+    ffmpeg_timeout: float | None = 3600
+    ffmpeg_cpu_limit: int | None = None
+    ffmpeg_memory_limit: int | None = None
+    ffprobe_timeout: float | None = 30
+    cover_workers: int | None = None
+    cover_avif: bool = True
+    cover_lazy: bool = False
+    cover_cache_size: int = 64 * 1024 * 1024
+    delivery_mode: DeliveryMode = DeliveryMode.PROXY
+    presigned_url_ttl: int = 300
+    archive_prefetch: int = 8
+    archive_prefetch_bytes: int = 64 * 1024 * 1024
+    upload_session_ttl: int = 24 * 3600
+    upload_cleanup_interval: int = 3600
+
     @computed_field()  # type: ignore[prop-decorator]
     @property
     def rabbit_dsn(self) -> str:
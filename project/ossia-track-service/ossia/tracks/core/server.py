@@ -10,7 +10,8 @@ from tortoise.contrib.fastapi import RegisterTortoise
 from ossia.tracks.config import TracksServiceConfig
 from ossia.tracks.database import models
 from ossia.tracks.routes import router
-from ossia.tracks.services.s3 import Buckets, S3Service
+from ossia.tracks.services.s3 import Buckets, S3Service, s3_pool
+from ossia.tracks.services.uploads import run_upload_cleanup
 from ossia.tracks.telemetry import (
     counter_middleware,
     duration_middleware,
@@ -20,17 +21,28 @@ from ossia.tracks.telemetry import (
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with S3Service() as s3:
-        await asyncio.gather(
-            *[s3.create_bucket(Bucket=bucket) for bucket in Buckets.all_buckets()],
-            return_exceptions=True,
-        )
-
-    db_url = TracksServiceConfig().postgres_dsn
-    async with RegisterTortoise(
-            app=app, modules={'ossia': [models]}, db_url=db_url, generate_schemas=True
-    ):
-        yield
+    await s3_pool.start()
+    try:
+        async with S3Service() as s3:
+            await asyncio.gather(
+                *[s3.create_bucket(Bucket=bucket) for bucket in Buckets.all_buckets()],
+                return_exceptions=True,
+            )
+
+        db_url = TracksServiceConfig().postgres_dsn
+        async with RegisterTortoise(
+                app=app,
+                modules={'ossia': [models]},
+                db_url=db_url,
+                generate_schemas=True,
+        ):
+            cleanup = asyncio.create_task(run_upload_cleanup())
+            try:
+                yield
+            finally:
+                cleanup.cancel()
+    finally:
+        await s3_pool.stop()
 
 
 app = FastAPI(
@@ -1,3 +1,4 @@
+import typing
 import uuid
 
 from tortoise import Model, fields
@@ -12,9 +13,21 @@ class Tracks(Model):
     creator: fields.ForeignKeyRelation['Creators'] = fields.ForeignKeyField(
         'ossia.Creators', null=False, related_name='tracks'
     )
+    creator_id: uuid.UUID
 
     has_cover = fields.BooleanField(default=False)
+    cover_color = fields.CharField(max_length=7, null=True)
+    cover_blurhash = fields.CharField(max_length=64, null=True)
     duration = fields.IntField(default=-1)
+    integrated_loudness: float | None = fields.FloatField(null=True)
+    loudness_range: float | None = fields.FloatField(null=True)
+    true_peak: float | None = fields.FloatField(null=True)
+    audio_key = fields.CharField(max_length=32, null=True)
+    renditions: list[str] = fields.JSONField(default=list)  # type: ignore[assignment]
+    content_hash = fields.CharField(max_length=64, null=True, db_index=True)
+    # CRC32 of FLAC master, valid while its ETag is still the same
+    flac_crc32 = fields.BigIntField(null=True)
+    flac_etag = fields.CharField(max_length=64, null=True)
 
     status = fields.CharEnumField(
         TrackStatus, default=TrackStatus.QUEUED, max_length=16
@@ -31,6 +44,54 @@ class Tracks(Model):
     edited_at = fields.DatetimeField(auto_now=True)
 
 
+class AudioRenditions(Model):
+    """
+    Index of encoded renditions by SHA-256 of uploaded source.
+    Renditions are stored under `key` and shared by every track with same source
+    """
+
+    content_hash = fields.CharField(max_length=64, primary_key=True)
+    key = fields.CharField(max_length=32, null=False)
+    renditions: list[str] = fields.JSONField(default=list)  # type: ignore[assignment]
+    duration = fields.IntField(default=-1)
+    integrated_loudness = fields.FloatField(null=True)
+    loudness_range = fields.FloatField(null=True)
+    true_peak = fields.FloatField(null=True)
+    ref_count = fields.IntField(default=0)
+
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+
+class ProcessingJobs(Model):
+    """
+    Progress of track processing, so redelivered request resumes it.
+    `renditions` maps bucket to its last finished step and S3 ETag once uploaded
+    """
+
+    id: uuid.UUID = fields.UUIDField(primary_key=True)
+    media: dict[str, typing.Any] | None = fields.JSONField(null=True)
+    renditions: dict[str, dict[str, str | None]] = fields.JSONField(default=dict)
+    attempts = fields.IntField(default=0)
+
+    created_at = fields.DatetimeField(auto_now_add=True)
+    edited_at = fields.DatetimeField(auto_now=True)
+
+
+class UploadSessions(Model):
+    id: uuid.UUID = fields.UUIDField(primary_key=True)
+    creator: fields.ForeignKeyRelation['Creators'] = fields.ForeignKeyField(
+        'ossia.Creators', null=False, related_name='upload_sessions'
+    )
+    track_id = fields.CharField(max_length=22, null=False)
+    title = fields.CharField(max_length=32, null=False)
+    description = fields.CharField(max_length=512, null=True)
+
+    audio_key = fields.CharField(max_length=64, null=False)
+    s3_upload_id = fields.CharField(max_length=1024, null=False)
+
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+
 class Tags(Model):
     id: uuid.UUID = fields.UUIDField(primary_key=True)
     value = fields.CharField(max_length=32, null=False, unique=True)
@@ -55,6 +116,7 @@ class Creators(Model):
         'ossia.Tags', related_name='creators'
     )
     tracks: fields.ReverseRelation[Tracks]
+    upload_sessions: fields.ReverseRelation[UploadSessions]
 
     created_at = fields.DatetimeField(auto_now_add=True)
     edited_at = fields.DatetimeField(auto_now=True)
@@ -20,7 +20,13 @@ class TrackInfo(BaseModel):
     title: str = Field(min_length=1, max_length=32)
     description: str | None = Field(max_length=512)
     duration: int
+    integrated_loudness: float | None = None
+    loudness_range: float | None = None
+    true_peak: float | None = None
     has_cover: bool
+    cover_color: str | None = None
+    cover_blurhash: str | None = None
+    renditions: list[str] = []
     visibility: TrackVisibility
     status: TrackStatus
     creator: CreatorInfo
@@ -37,6 +43,28 @@ class TracksResponse(BaseModel):
     tracks: list[TrackInfo]
 
 
+class PresignedUrl(BaseModel):
+    url: str
+    expires_in: int
+
+
+class CreateUpload(BaseModel):
+    title: str = Field(min_length=1, max_length=32)
+    description: str | None = Field(None, max_length=512)
+
+
+class UploadedPart(BaseModel):
+    part_number: int
+    size: int
+    etag: str
+
+
+class UploadInfo(BaseModel):
+    id: uuid.UUID
+    part_size: int
+    parts: list[UploadedPart] = []
+
+
 class UpdateTrack(BaseModel):
     title: str | None = None
     description: str | None = None
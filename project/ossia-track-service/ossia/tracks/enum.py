@@ -14,6 +14,16 @@ class TrackStatus(enum.StrEnum):
     ERROR = 'error'
 
 
+class JobStep(enum.StrEnum):
+    """
+    Last finished processing step of a single rendition
+    """
+
+    PROBED = 'probed'
+    ENCODED = 'encoded'
+    UPLOADED = 'uploaded'
+
+
 class TrackVisibility(enum.StrEnum):
     """
     Track visibility enum used in database.
@@ -26,6 +36,17 @@ class TrackVisibility(enum.StrEnum):
     PRIVATE = 'private'
 
 
+class DeliveryMode(enum.StrEnum):
+    """
+    How media bytes reach clients: proxied by the service
+    or fetched from S3 by presigned URL
+    """
+
+    PROXY = 'proxy'
+    REDIRECT = 'redirect'
+    JSON = 'json'
+
+
 class DownloadType(enum.StrEnum):
     ALL = 'all'
     SELECTED = 'selected'
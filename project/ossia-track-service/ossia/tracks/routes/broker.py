@@ -1,5 +1,7 @@
 import asyncio
+import io
 import tempfile
+import typing
 
 from faststream.exceptions import AckMessage
 from faststream.rabbit.fastapi import RabbitRouter
@@ -9,11 +11,13 @@ from pydantic import BaseModel
 
 from ossia.tracks.config import TracksServiceConfig
 from ossia.tracks.services.covers import process_cover
-from ossia.tracks.services.encode import FFMpegEncoder
-from ossia.tracks.services.s3 import Buckets, S3Service
+from ossia.tracks.services.encode import FFMpegEncoder, MediaInfo
+from ossia.tracks.services.renditions import link_renditions, register_renditions
+from ossia.tracks.services.s3 import Buckets, S3Service, s3_pool
 
+config = TracksServiceConfig()
 router = RabbitRouter(
-    TracksServiceConfig().rabbit_dsn,
+    config.rabbit_dsn,
     max_consumers=5,
     middlewares=(
         RabbitTelemetryMiddleware(
@@ -24,17 +28,55 @@ router = RabbitRouter(
 )
 
 
+@router.after_startup
+async def start_s3_pool(_app: typing.Any) -> None:
+    await s3_pool.start()
+
+
+@router.on_broker_shutdown
+async def stop_s3_pool(_app: typing.Any) -> None:
+    await s3_pool.stop()
+
+
 class ProcessingRequest(BaseModel):
     track_id: str
     cover_key: str | None = None
     audio_key: str
+    media: MediaInfo | None = None
+    content_hash: str | None = None
+
+
+async def stream_cover_and_track(
+        track_id: str, audio_key: str, cover_key: str, media: MediaInfo | None
+) -> None:
+    async with S3Service() as s3:
+        res = await s3.get_object(Bucket=Buckets.BUFFER, Key=cover_key)
+        cover_io = io.BytesIO(await res['Body'].read())
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(
+            FFMpegEncoder(track_id=track_id, media=media).process_stream(audio_key)
+        )
+        tg.create_task(process_cover(cover_io, track_id))
+
+    async with S3Service() as s3:
+        await asyncio.gather(
+            s3.delete_object(Bucket=Buckets.BUFFER, Key=audio_key),
+            s3.delete_object(Bucket=Buckets.BUFFER, Key=cover_key),
+        )
 
 
 async def process_cover_and_track(
-        track_id: str, audio_key: str, cover_key: str | None
+        track_id: str,
+        audio_key: str,
+        cover_key: str | None,
+        media: MediaInfo | None = None,
 ) -> None:
     if cover_key is None:
         raise TypeError('cover_key must be str')
+    if config.encode_streaming:
+        await stream_cover_and_track(track_id, audio_key, cover_key, media)
+        return
 
     tmp = tempfile.TemporaryDirectory()
 
@@ -53,7 +95,10 @@ async def process_cover_and_track(
                 ),
             )
         ffmpeg = FFMpegEncoder(
-            tmp_path=tmp.name, file_path=f'{tmp.name}/{audio_key}', track_id=track_id
+            tmp_path=tmp.name,
+            file_path=f'{tmp.name}/{audio_key}',
+            track_id=track_id,
+            media=media,
         )
 
         async with asyncio.TaskGroup() as tg:
@@ -69,7 +114,15 @@ async def process_cover_and_track(
         tmp.cleanup()
 
 
-async def process_track(track_id: str, audio_key: str) -> None:
+async def process_track(
+        track_id: str, audio_key: str, media: MediaInfo | None = None
+) -> None:
+    if config.encode_streaming:
+        await FFMpegEncoder(track_id=track_id, media=media).process_stream(audio_key)
+        async with S3Service() as s3:
+            await s3.delete_object(Bucket=Buckets.BUFFER, Key=audio_key)
+        return
+
     tmp = tempfile.TemporaryDirectory(delete=False)
     try:
         async with S3Service() as s3:
@@ -78,7 +131,10 @@ async def process_track(track_id: str, audio_key: str) -> None:
             )
         print('File downloaded')
         ffmpeg = FFMpegEncoder(
-            file_path=f'{tmp.name}/{track_id}', track_id=track_id, tmp_path=tmp.name
+            file_path=f'{tmp.name}/{track_id}',
+            track_id=track_id,
+            tmp_path=tmp.name,
+            media=media,
         )
         await ffmpeg.process()
         async with S3Service() as s3:
@@ -88,18 +144,45 @@ async def process_track(track_id: str, audio_key: str) -> None:
         pass
 
 
+async def process_linked(track_id: str, audio_key: str, cover_key: str | None) -> None:
+    """
+    Audio renditions are already linked, only cover is left to be processed
+    """
+    keys = [audio_key]
+    if cover_key is not None:
+        keys.append(cover_key)
+        async with S3Service() as s3:
+            res = await s3.get_object(Bucket=Buckets.BUFFER, Key=cover_key)
+            cover_io = io.BytesIO(await res['Body'].read())
+        await process_cover(cover_io, track_id)
+
+    async with S3Service() as s3:
+        await asyncio.gather(
+            *[s3.delete_object(Bucket=Buckets.BUFFER, Key=key) for key in keys]
+        )
+
+
 @router.subscriber('track-process', no_reply=True)
 async def launch_track_processing(body: ProcessingRequest) -> None:
-    if body.cover_key is None:
-        t = asyncio.create_task(process_track(body.track_id, body.audio_key))
-        await asyncio.sleep(0)
-        await t
+    if body.content_hash is not None and await link_renditions(
+            body.track_id, body.content_hash
+    ):
+        await process_linked(body.track_id, body.audio_key, body.cover_key)
         raise AckMessage()
 
-    t = asyncio.create_task(
-        process_cover_and_track(body.track_id, body.audio_key, body.cover_key)
-    )
+    if body.cover_key is None:
+        t = asyncio.create_task(
+            process_track(body.track_id, body.audio_key, body.media)
+        )
+    else:
+        t = asyncio.create_task(
+            process_cover_and_track(
+                body.track_id, body.audio_key, body.cover_key, body.media
+            )
+        )
     await asyncio.sleep(0)
     await t
 
+    if body.content_hash is not None:
+        await register_renditions(body.track_id, body.content_hash)
     raise AckMessage()
@@ -1,16 +1,15 @@
 import asyncio
+import hashlib
 import io
-import uuid
 from datetime import datetime
-from typing import Annotated, AsyncGenerator, Literal
+from typing import Annotated, AsyncGenerator
 
-from aiobotocore.response import StreamingBody
-from aioitertools import enumerate as aenumerate
 from fastapi import (
     APIRouter,
     BackgroundTasks,
     Depends,
     Form,
+    Header,
     HTTPException,
     Query,
     Security,
@@ -19,8 +18,6 @@ from fastapi import (
 from faststream.rabbit import RabbitBroker
 from starlette import status
 from starlette.responses import StreamingResponse
-from tortoise.functions import Count
-from tortoise.queryset import ValuesListQuery
 
 from ossia.common.propdict import PropDict
 from ossia.tracks.database.models import Creators, Tracks
@@ -36,26 +33,74 @@ from ossia.tracks.dependencies import (
     get_creator,
     optionally_auth_user,
 )
-from ossia.tracks.enum import DownloadType, TrackVisibility
+from ossia.tracks.enum import DownloadType, TrackStatus, TrackVisibility
 from ossia.tracks.routes.broker import ProcessingRequest
 from ossia.tracks.services.covers import CoverFormats, probe_cover
-from ossia.tracks.services.download import create_files_zip
+from ossia.tracks.services.download import (
+    ArchiveFile,
+    archive_fingerprint,
+    archive_key,
+    cached_archive_size,
+    create_files_zip,
+    layout_archive,
+    stream_cached_archive,
+)
 from ossia.tracks.services.encode import FFMpegEncoder, sanitize_title
-from ossia.tracks.services.s3 import Buckets, S3Service
+from ossia.tracks.services.renditions import renditions_key
+from ossia.tracks.services.s3 import Buckets, S3Service, upload_chunks
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+
+def _archive_files(tracks: list[Tracks]) -> list[ArchiveFile]:
+    counter_len = len(str(len(tracks)))
+    return [
+        ArchiveFile(
+            name=f'{i:0>{counter_len}}-{sanitize_title(track.title)}.flac',
+            key=f'{renditions_key(track)}.flac',
+            # Entries must be identical in every response to resume downloads
+            modified=track.edited_at,
+            crc=track.flac_crc32,
+            etag=track.flac_etag,
+        )
+        for i, track in enumerate(tracks)
+    ]
+
+
+def _archive_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parses single byte range into [start, end), None if it should be ignored
+    """
+    unit, _, spec = header.partition('=')
+    start_str, sep, end_str = spec.strip().partition('-')
+    if unit.strip().lower() != 'bytes' or not sep or ',' in spec:
+        return None
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) + 1 if end_str else size
+        else:
+            start, end = max(size - int(end_str), 0), size
+    except ValueError:
+        return None
+    end = min(end, size)
+    if start >= end:
+        raise HTTPException(
+            status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            'Requested Range Not Satisfiable',
+            headers={'Content-Range': f'bytes */{size}'},
+        )
+    return start, end
 
-async def _body_gen(
-        counter_len: int,
-        values_gen: AsyncGenerator[tuple[uuid.UUID, str], None]
-                    | ValuesListQuery[Literal[False]],
-) -> AsyncGenerator[tuple[str, StreamingBody], None]:
-    async with S3Service() as s3:
-        async for i, (track_id, title) in aenumerate(values_gen):
-            encoded_id = FFMpegEncoder.encode_track_id(track_id)
-            body = (
-                await s3.get_object(Bucket=Buckets.RAW_TRACKS, Key=f'{encoded_id}.flac')
-            )['Body']
-            yield f'{i:0>{counter_len}}-{sanitize_title(title)}.flac', body
+
+async def _upload_chunks(
+        prefix: bytes, file: UploadFile, hasher: 'hashlib._Hash'
+) -> AsyncGenerator[bytes, None]:
+    hasher.update(prefix)
+    yield prefix
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        hasher.update(chunk)
+        yield chunk
 
 
 router = APIRouter(prefix='/{creator_id}/tracks')
@@ -93,44 +138,65 @@ async def upload_track(
             status.HTTP_403_FORBIDDEN,
             f'You cannot publish track for creator {creator_id}',
         )
-    track_io = io.BytesIO(await track.read())
-    is_supported, probed_format = await FFMpegEncoder.probe_binary(track_io)
-    uuid_, encoded = FFMpegEncoder.generate_track_id()
-    if not is_supported:
-        raise HTTPException(
-            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, 'Only WAV and FLAC files supported'
-        )
-    audio_key = f'{encoded}/audio.{probed_format}'
-    record = await Tracks.create(
-        id=uuid_, title=title, description=description, creator=creator
-    )
+    read = bytearray()
 
-    if not isinstance(cover, UploadFile):
-        async with S3Service() as s3:
-            await s3.upload_fileobj(track_io, Bucket=Buckets.BUFFER, Key=audio_key)
-        msg = ProcessingRequest(track_id=encoded, audio_key=audio_key, cover_key=None)
-        tasks.add_task(broker.publish, msg, 'track-process')
-        return TrackInfo.model_validate(record, from_attributes=True)
+    async def _read_prefix(size: int) -> bytes:
+        read.extend(await track.read(size - len(read)))
+        return bytes(read)
 
-    cover_io = io.BytesIO(await cover.read())
-    cover_format = probe_cover(cover_io)
-    if not cover_format or cover_format not in (CoverFormats.JPEG, CoverFormats.PNG):
+    try:
+        media, prefix = await FFMpegEncoder.probe_prefix(_read_prefix)
+    except RuntimeError:
+        media, prefix = None, bytes(read)
+    if media is None:
         raise HTTPException(
-            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            'Only PNG and JPEG files are supported',
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, 'Only WAV and FLAC files supported'
         )
 
-    cover_key = f'{encoded}/cover.{cover_format}'
+    cover_io = None
+    cover_key = None
+    uuid_, encoded = FFMpegEncoder.generate_track_id()
+    if isinstance(cover, UploadFile):
+        cover_io = io.BytesIO(await cover.read())
+        cover_format = probe_cover(cover_io)
+        if not cover_format or cover_format not in (
+                CoverFormats.JPEG,
+                CoverFormats.PNG,
+        ):
+            raise HTTPException(
+                status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                'Only PNG and JPEG files are supported',
+            )
+        cover_io.seek(0)
+        cover_key = f'{encoded}/cover.{cover_format}'
+
+    audio_key = f'{encoded}/audio.{media.format}'
+    hasher = hashlib.sha256()
     async with S3Service() as s3:
         async with asyncio.TaskGroup() as tg:
             tg.create_task(
-                s3.upload_fileobj(track_io, Bucket=Buckets.BUFFER, Key=audio_key)
-            )
-            tg.create_task(
-                s3.upload_fileobj(cover_io, Bucket=Buckets.BUFFER, Key=cover_key)
+                upload_chunks(
+                    s3,
+                    _upload_chunks(prefix, track, hasher),
+                    Buckets.BUFFER,
+                    audio_key,
+                )
             )
+            if cover_io is not None and cover_key is not None:
+                tg.create_task(
+                    s3.upload_fileobj(cover_io, Bucket=Buckets.BUFFER, Key=cover_key)
+                )
 
-    msg = ProcessingRequest(track_id=encoded, audio_key=audio_key, cover_key=cover_key)
+    record = await Tracks.create(
+        id=uuid_, title=title, description=description, creator=creator
+    )
+    msg = ProcessingRequest(
+        track_id=encoded,
+        audio_key=audio_key,
+        cover_key=cover_key,
+        media=media,
+        content_hash=hasher.hexdigest(),
+    )
     tasks.add_task(broker.publish, msg, 'track-process')
     return TrackInfo.model_validate(record, from_attributes=True)
 
@@ -140,6 +206,8 @@ async def download_creator_tracks(
         creator: Annotated[Creators, Depends(get_creator)],
         user: Annotated[User, Security(auth_user)],
         body: DownloadTracks,
+        _range: Annotated[str | None, Header(alias='range')] = None,
+        if_range: Annotated[str | None, Header()] = None,
 ) -> StreamingResponse:
     if user.oid != creator.owner:
         raise HTTPException(status.HTTP_403_FORBIDDEN)
@@ -161,22 +229,57 @@ async def download_creator_tracks(
         case _:
             raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, 'Invalid action')
 
-    count_len = len(
-        str(
-            await query.annotate(count=Count('id'))
-            .first()
-            .values_list('count', flat=True)
-        )
-    )
+    # Tracks still being encoded have no master to put in the archive yet
+    query = query.filter(status=TrackStatus.READY)
+    tracks = await query.order_by('created_at', 'id')
+    fingerprint = archive_fingerprint(tracks)
+    key = archive_key(creator.id, fingerprint)
+    etag = f'"{fingerprint}"'
+    headers = {
+        'Content-Disposition': f'attachment; filename={creator.id.hex}-tracks-{now}.zip',
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+    }
 
-    gen = create_files_zip(
-        count_len, _body_gen(count_len, query.values_list('id', 'title', flat=True))
-    )
+    files = _archive_files(tracks)
+    archive = None
+    size = await cached_archive_size(key)
+    if size is None:
+        archive = await layout_archive(Buckets.RAW_TRACKS, files)
+        size = archive.size
+
+    byte_range = None
+    if _range is not None and if_range in (None, etag):
+        byte_range = _archive_range(_range, size)
+    start, end = byte_range or (0, size)
+    headers['Content-Length'] = str(end - start)
+    if byte_range is not None:
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+
+    if archive is None:
+        gen = stream_cached_archive(key, start, end)
+    else:
+
+        async def _store_checksum(index: int, crc: int) -> None:
+            await Tracks.filter(id=tracks[index].id).update(
+                flac_crc32=crc, flac_etag=files[index].etag
+            )
+
+        gen = create_files_zip(
+            Buckets.RAW_TRACKS,
+            files,
+            archive,
+            start,
+            end,
+            cache_key=key,
+            on_checksum=_store_checksum,
+        )
 
     return StreamingResponse(
         gen,
+        status_code=status.HTTP_206_PARTIAL_CONTENT
+        if byte_range is not None
+        else status.HTTP_200_OK,
         media_type='application/octet-stream',
-        headers={
-            'Content-Disposition': f'attachment; filename={creator.id.hex}-tracks-{now}.zip'
-        },
+        headers=headers,
     )
@@ -0,0 +1,208 @@
+import uuid
+from collections.abc import AsyncGenerator
+from typing import Annotated
+
+import tortoise.exceptions
+from botocore.exceptions import ClientError
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Path, Request
+from faststream.rabbit import RabbitBroker
+from starlette import status
+
+from ossia.tracks.database.models import Creators, Tracks, UploadSessions
+from ossia.tracks.datamodels.tracks import (
+    CreateUpload,
+    TrackInfo,
+    UploadedPart,
+    UploadInfo,
+)
+from ossia.tracks.dependencies import get_broker, get_creator_secure
+from ossia.tracks.routes.broker import ProcessingRequest
+from ossia.tracks.services.encode import FFMpegEncoder
+from ossia.tracks.services.s3 import (
+    PART_SIZE,
+    Buckets,
+    S3Client,
+    S3Service,
+    upload_chunks,
+)
+from ossia.tracks.services.uploads import abort_upload_session, upload_expiry
+
+MAX_PART_SIZE = 64 * 1024 * 1024  # 64 MB
+MAX_PARTS = 10000
+
+router = APIRouter(prefix='/{creator_id}/tracks/uploads')
+
+
+async def get_upload_session(
+        upload_id: uuid.UUID, creator: Annotated[Creators, Depends(get_creator_secure)]
+) -> UploadSessions:
+    try:
+        return await UploadSessions.get(
+            id=upload_id, creator=creator, created_at__gte=upload_expiry()
+        )
+    except tortoise.exceptions.DoesNotExist:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Upload session not found')
+
+
+async def _list_parts(s3: S3Client, session: UploadSessions) -> list[UploadedPart]:
+    parts: list[UploadedPart] = []
+    marker = 0
+    while True:
+        res = await s3.list_parts(
+            Bucket=Buckets.BUFFER,
+            Key=session.audio_key,
+            UploadId=session.s3_upload_id,
+            PartNumberMarker=marker,
+        )
+        parts.extend(
+            UploadedPart(
+                part_number=part['PartNumber'], size=part['Size'], etag=part['ETag']
+            )
+            for part in res.get('Parts', [])
+        )
+        if not res.get('IsTruncated'):
+            return parts
+        marker = res['NextPartNumberMarker']
+
+
+@router.post('/', status_code=status.HTTP_201_CREATED)
+async def create_upload(
+        creator: Annotated[Creators, Depends(get_creator_secure)], body: CreateUpload
+) -> UploadInfo:
+    _, encoded = FFMpegEncoder.generate_track_id()
+    audio_key = f'{encoded}/audio'
+    async with S3Service() as s3:
+        res = await s3.create_multipart_upload(Bucket=Buckets.BUFFER, Key=audio_key)
+    session = await UploadSessions.create(
+        creator=creator,
+        track_id=encoded,
+        title=body.title,
+        description=body.description,
+        audio_key=audio_key,
+        s3_upload_id=res['UploadId'],
+    )
+    return UploadInfo(id=session.id, part_size=PART_SIZE)
+
+
+@router.get('/{upload_id}')
+async def get_upload(
+        session: Annotated[UploadSessions, Depends(get_upload_session)],
+) -> UploadInfo:
+    async with S3Service() as s3:
+        parts = await _list_parts(s3, session)
+    return UploadInfo(id=session.id, part_size=PART_SIZE, parts=parts)
+
+
+@router.put('/{upload_id}/parts/{part_number}')
+async def upload_part(
+        request: Request,
+        session: Annotated[UploadSessions, Depends(get_upload_session)],
+        part_number: Annotated[int, Path(ge=1, le=MAX_PARTS)],
+) -> UploadedPart:
+    content_length = request.headers.get('content-length')
+    if content_length is None:
+        raise HTTPException(status.HTTP_411_LENGTH_REQUIRED)
+    if not content_length.isdecimal():
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Invalid Content-Length')
+    if int(content_length) > MAX_PART_SIZE:
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f'Part must not be larger than {MAX_PART_SIZE} bytes',
+        )
+
+    size = 0
+
+    async def _chunks() -> AsyncGenerator[bytes, None]:
+        nonlocal size
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > MAX_PART_SIZE:
+                raise HTTPException(
+                    status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    f'Part must not be larger than {MAX_PART_SIZE} bytes',
+                )
+            yield chunk
+
+    # Part is streamed into its own object, so it's never held in memory whole,
+    # and then copied into the upload by S3
+    part_key = f'{session.audio_key}.{part_number}'
+    async with S3Service() as s3:
+        await upload_chunks(s3, _chunks(), Buckets.BUFFER, part_key)
+        try:
+            res = await s3.upload_part_copy(
+                Bucket=Buckets.BUFFER,
+                Key=session.audio_key,
+                UploadId=session.s3_upload_id,
+                PartNumber=part_number,
+                CopySource={'Bucket': Buckets.BUFFER, 'Key': part_key},
+            )
+        finally:
+            await s3.delete_object(Bucket=Buckets.BUFFER, Key=part_key)
+    return UploadedPart(
+        part_number=part_number, size=size, etag=res['CopyPartResult']['ETag']
+    )
+
+
+@router.post('/{upload_id}/complete')
+async def complete_upload(
+        tasks: BackgroundTasks,
+        broker: Annotated[RabbitBroker, Depends(get_broker)],
+        creator: Annotated[Creators, Depends(get_creator_secure)],
+        session: Annotated[UploadSessions, Depends(get_upload_session)],
+) -> TrackInfo:
+    async with S3Service() as s3:
+        parts = await _list_parts(s3, session)
+        if not parts:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, 'No parts were uploaded')
+        try:
+            await s3.complete_multipart_upload(
+                Bucket=Buckets.BUFFER,
+                Key=session.audio_key,
+                UploadId=session.s3_upload_id,
+                MultipartUpload={
+                    'Parts': [
+                        {'PartNumber': part.part_number, 'ETag': part.etag}
+                        for part in parts
+                    ]
+                },
+            )
+        except ClientError as e:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, f'Unable to complete upload: {e}'
+            )
+
+        try:
+            media = await FFMpegEncoder.probe_object(
+                s3, Buckets.BUFFER, session.audio_key
+            )
+        except RuntimeError:
+            media = None
+        if media is None:
+            await s3.delete_object(Bucket=Buckets.BUFFER, Key=session.audio_key)
+            await session.delete()
+            raise HTTPException(
+                status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                'Only WAV and FLAC files supported',
+            )
+
+    record = await Tracks.create(
+        id=FFMpegEncoder.decode_track_id(session.track_id),
+        title=session.title,
+        description=session.description,
+        creator=creator,
+    )
+    await session.delete()
+
+    msg = ProcessingRequest(
+        track_id=session.track_id, audio_key=session.audio_key, media=media
+    )
+    tasks.add_task(broker.publish, msg, 'track-process')
+    return TrackInfo.model_validate(record, from_attributes=True)
+
+
+@router.delete('/{upload_id}', status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload(
+        session: Annotated[UploadSessions, Depends(get_upload_session)],
+) -> None:
+    async with S3Service() as s3:
+        await abort_upload_session(s3, session)
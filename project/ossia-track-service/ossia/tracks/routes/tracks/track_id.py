@@ -3,16 +3,40 @@ from typing import Annotated, Literal
 
 from fastapi import APIRouter, HTTPException, Query
 from fastapi.params import Depends, Header
+from fastapi.responses import ORJSONResponse
 from starlette import status
-from starlette.responses import StreamingResponse
+from starlette.responses import RedirectResponse, Response, StreamingResponse
 
+from ossia.tracks.config import TracksServiceConfig
 from ossia.tracks.database.models import Tags, Tracks
-from ossia.tracks.datamodels.tracks import TrackInfo, UpdateTrack
+from ossia.tracks.datamodels.tracks import PresignedUrl, TrackInfo, UpdateTrack
 from ossia.tracks.dependencies import get_track, get_track_secure
-from ossia.tracks.services.s3 import Buckets, S3Service
+from ossia.tracks.enum import DeliveryMode, TrackVisibility
+from ossia.tracks.services.covers import (
+    COVER_VARIANTS,
+    CoverVariants,
+    cover_cache,
+    cover_key,
+    fetch_cover,
+    render_cover,
+    resolve_cover,
+)
+from ossia.tracks.services.download import invalidate_archives
+from ossia.tracks.services.encode import BITRATES
+from ossia.tracks.services.renditions import (
+    ready_renditions,
+    release_renditions,
+    renditions_key,
+)
+from ossia.tracks.services.s3 import Buckets, S3Service, presign_object
+from ossia.tracks.services.waveform import waveform_key
 
 BYTES_PER_REQEUST = 512 * 1024
+CACHE_MAX_AGE = 86400
+PLAYBACK_PREFERENCE = (Buckets.OGG_160, Buckets.OGG_96, Buckets.OGG_320)
+OPUS_PLAYBACK_PREFERENCE = (Buckets.OPUS_96, Buckets.OPUS_64, Buckets.OPUS_160)
 router = APIRouter(prefix='/{track_id}')
+config = TracksServiceConfig()
 
 
 @router.get('/')
@@ -42,44 +66,224 @@ async def update_track_info(
 
         await track.tags.add(*records)
     await track.save()
+    await invalidate_archives(track.creator_id)
     await track.fetch_related('creator')
     return TrackInfo.model_validate(track, from_attributes=True)
 
 
 @router.delete('/', status_code=status.HTTP_204_NO_CONTENT)
 async def delete_track(track: Annotated[Tracks, Depends(get_track_secure)]) -> None:
+    await release_renditions(track)
     await track.delete()
+    await invalidate_archives(track.creator_id)
+
+
+def _refused(params: list[str]) -> bool:
+    """
+    Tells whether Accept item parameters give it zero quality
+    """
+    for param in params:
+        name, _, value = param.partition('=')
+        if name.strip() != 'q':
+            continue
+        try:
+            return float(value.strip()) <= 0
+        except ValueError:
+            return False
+    return False
+
+
+def _accepted_media_types(accept: str | None) -> set[str]:
+    if not accept:
+        return set()
+    accepted = set()
+    for item in accept.lower().split(','):
+        media_type, *params = [param.strip() for param in item.split(';')]
+        if not _refused(params):
+            accepted.add(media_type)
+    return accepted
+
+
+async def _presigned_response(bucket: Buckets, key: str, media_type: str) -> Response:
+    """
+    Points client to the object in S3 instead of proxying its bytes
+    """
+    url = await presign_object(bucket, key, media_type)
+    headers = {
+        # Response must not outlive the URL it points to
+        'Cache-Control': f'private, max-age={config.presigned_url_ttl // 2}',
+        'Vary': 'Accept',
+    }
+    if config.delivery_mode == DeliveryMode.REDIRECT:
+        return RedirectResponse(
+            url, status.HTTP_307_TEMPORARY_REDIRECT, headers=headers
+        )
+    return ORJSONResponse(
+        PresignedUrl(url=url, expires_in=config.presigned_url_ttl).model_dump(),
+        headers=headers,
+    )
+
+
+def _cache_control(track: Tracks) -> str:
+    """
+    Shared caches may keep only assets of public tracks, others are served
+    to the users allowed to see them
+    """
+    if track.visibility == TrackVisibility.PUBLIC:
+        return f'public, max-age={CACHE_MAX_AGE}'
+    return f'private, max-age={CACHE_MAX_AGE}'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses weak comparison
+    return any(
+        tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(',')
+    )
+
+
+def _cover_preference(accept: str | None) -> list[CoverVariants]:
+    """
+    Returns cover variants client accepts, smallest first. Only explicitly
+    listed formats are used, JPEG is always the last resort
+    """
+    accepted = _accepted_media_types(accept)
+    return [
+        variant
+        for variant in COVER_VARIANTS
+        if variant == CoverVariants.JPEG or variant.media_type in accepted
+    ]
 
 
 @router.get('/cover')
 async def get_track_cover(
         track_id: str, track: Annotated[Tracks, Depends(get_track)],
-        size: Annotated[Literal[256, 512, 1024, 2048, 3000], Query()] = 256
-):
+        size: Annotated[Literal[256, 512, 1024, 2048, 3000], Query()] = 256,
+        accept: Annotated[str | None, Header()] = None,
+        if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
     if not track.has_cover:
         raise HTTPException(status.HTTP_404_NOT_FOUND, 'No cover for this track')
-    async with S3Service() as s3:
-        res = await s3.get_object(
-            Bucket=Buckets.COVERS, Key=f'{track_id}/cover{size}.jpg'
+    preference = _cover_preference(accept)
+    if config.delivery_mode != DeliveryMode.PROXY:
+        variant = await resolve_cover(track_id, size, preference)
+        if variant is None and await render_cover(track_id, size):
+            variant = await resolve_cover(track_id, size, preference)
+        if variant is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, 'No cover for this track')
+        return await _presigned_response(
+            Buckets.COVERS, cover_key(track_id, size, variant), variant.media_type
         )
-    return StreamingResponse(res['Body'], status_code=status.HTTP_200_OK, media_type='image/jpeg')
+
+    cache_key = (track_id, size, tuple(preference))
+    cover = cover_cache.get(cache_key)
+    if cover is None:
+        cover = await fetch_cover(track_id, size, preference)
+        if cover is None and await render_cover(track_id, size):
+            cover = await fetch_cover(track_id, size, preference)
+        if cover is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, 'No cover for this track')
+        cover_cache.put(cache_key, cover)
+
+    headers = {
+        'ETag': cover.etag,
+        'Cache-Control': _cache_control(track),
+        'Vary': 'Accept',
+    }
+    if _etag_matches(if_none_match, cover.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(cover.data, media_type=cover.media_type, headers=headers)
 
 
-async def get_stream(track_id: str, start: int, end: int) -> StreamingResponse:
+@router.get('/waveform')
+async def get_track_waveform(
+        track: Annotated[Tracks, Depends(get_track)],
+        resolution: Annotated[Literal[256, 512, 1024, 2048, 4096], Query()] = 1024,
+) -> Response:
+    """
+    Returns peaks of the track as `resolution` pairs of signed 8-bit min/max values
+    """
+    async with S3Service() as s3:
+        try:
+            res = await s3.get_object(
+                Bucket=Buckets.WAVEFORMS,
+                Key=waveform_key(renditions_key(track), resolution),
+            )
+            data = await res['Body'].read()
+        except s3.exceptions.NoSuchKey:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, 'No waveform for this track')
+    return Response(
+        data,
+        media_type='application/octet-stream',
+        headers={'Cache-Control': _cache_control(track)},
+    )
+
+
+def _accepts_opus(accept: str | None) -> bool:
+    if not accept:
+        return False
+    for item in accept.lower().split(','):
+        media_type, *params = [param.strip() for param in item.split(';')]
+        if _refused(params):
+            continue
+        if media_type == 'audio/opus':
+            return True
+        if media_type in ('audio/ogg', 'audio/*') and 'codecs=opus' in params:
+            return True
+    return False
+
+
+def _playback_bucket(track: Tracks, quality: int | None, opus: bool) -> Buckets:
+    """
+    Picks best ready rendition, Opus ones are preferred when client supports them.
+    Quality is given as Vorbis bitrate, Opus rendition of the same tier is used
+    """
+    ready = ready_renditions(track)
+    preference = list(PLAYBACK_PREFERENCE)
+    if opus:
+        preference[:0] = OPUS_PLAYBACK_PREFERENCE
+    if quality is not None:
+        tier = BITRATES.index(quality)
+        preference.insert(0, Buckets.ogg_buckets()[tier])
+        if opus:
+            preference.insert(0, Buckets.opus_buckets()[tier])
+    for bucket in preference:
+        if bucket in ready:
+            return bucket
+    raise HTTPException(status.HTTP_404_NOT_FOUND, 'Track is not processed yet')
+
+
+def _playback_media_type(bucket: Buckets) -> str:
+    if bucket == Buckets.RAW_TRACKS:
+        return 'audio/flac'
+    if bucket in Buckets.opus_buckets():
+        return 'audio/ogg; codecs=opus'
+    return 'audio/ogg'
+
+
+async def get_stream(
+        bucket: Buckets, key: str, start: int, end: int
+) -> StreamingResponse:
     async with S3Service() as s3:
         try:
             res = await s3.get_object(
-                Bucket=Buckets.OGG_160, Key=f'{track_id}', Range=f'bytes={start}-{end}'
+                Bucket=bucket,
+                Key=f'{key}.{bucket.extension}',
+                Range=f'bytes={start}-{end}',
             )
             headers = {
                 'Content-Range': res['ContentRange'],
                 'Accept-Ranges': 'bytes',
                 'Content-Length': str(res['ContentLength']),
+                'Vary': 'Accept',
             }
             return StreamingResponse(
                 res['Body'],
                 status_code=status.HTTP_206_PARTIAL_CONTENT,
-                media_type='audio/ogg',
+                media_type=_playback_media_type(bucket),
                 headers=headers,
             )
         except Exception:
@@ -91,12 +295,21 @@ async def get_stream(track_id: str, start: int, end: int) -> StreamingResponse:
 
 @router.get('/playback', status_code=status.HTTP_206_PARTIAL_CONTENT)
 async def stream_track(
-        track_id: str,
         track: Annotated[Tracks, Depends(get_track)],
         _range: Annotated[str | None, Header(alias='range')] = None,
-) -> StreamingResponse:
+        quality: Annotated[Literal[96, 160, 320] | None, Query()] = None,
+        codec: Annotated[Literal['opus', 'vorbis'] | None, Query()] = None,
+        accept: Annotated[str | None, Header()] = None,
+) -> Response:
+    opus = codec == 'opus' or (codec is None and _accepts_opus(accept))
+    bucket = _playback_bucket(track, quality, opus)
+    key = renditions_key(track)
+    if config.delivery_mode != DeliveryMode.PROXY:
+        return await _presigned_response(
+            bucket, f'{key}.{bucket.extension}', _playback_media_type(bucket)
+        )
     if _range is None:
-        return await get_stream(track_id, 0, BYTES_PER_REQEUST - 1)
+        return await get_stream(bucket, key, 0, BYTES_PER_REQEUST - 1)
 
     try:
         byte_range = _range.strip().lower().replace('bytes=', '')
@@ -108,4 +321,4 @@ async def stream_track(
             status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, 'Invalid Range header'
         )
 
-    return await get_stream(track_id, start, end)
+    return await get_stream(bucket, key, start, end)
@@ -0,0 +1,76 @@
+import math
+
+import numpy as np
+import numpy.typing as npt
+from PIL import Image
+
+BASE83 = (
+    '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    'abcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+)
+# Components are computed on a thumbnail, they carry no detail finer than that
+BLURHASH_SIZE = 32
+
+
+def _base83(value: int, length: int) -> str:
+    return ''.join(
+        BASE83[value // 83 ** (length - i - 1) % 83] for i in range(length)
+    )
+
+
+def _srgb_to_linear(values: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    values = values / 255
+    return np.where(
+        values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4
+    )
+
+
+def _linear_to_srgb(value: float) -> int:
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value: float, exp: float) -> float:
+    return math.copysign(abs(value) ** exp, value)
+
+
+def encode(img: Image.Image, x_components: int = 4, y_components: int = 3) -> str:
+    """
+    Encodes RGB image into BlurHash string, compact blurred placeholder
+    decoded by clients without fetching the image
+    """
+    img = img.resize((BLURHASH_SIZE, BLURHASH_SIZE), Image.Resampling.BOX)
+    pixels = _srgb_to_linear(np.asarray(img, dtype=np.float64))
+    height, width, _ = pixels.shape
+
+    basis_x = np.cos(np.pi * np.outer(np.arange(x_components), np.arange(width)) / width)
+    basis_y = np.cos(
+        np.pi * np.outer(np.arange(y_components), np.arange(height)) / height
+    )
+    # factors[j, i] is mean of pixels weighted by cosine basis (i, j)
+    factors = np.einsum('jy,ix,yxc->jic', basis_y, basis_x, pixels) / (width * height)
+    factors[1:] *= 2
+    factors[0, 1:] *= 2
+    factors = factors.reshape(-1, 3)
+    dc, ac = factors[0], factors[1:]
+
+    blurhash = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if len(ac):
+        quantised_max = max(0, min(82, int(np.abs(ac).max() * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+        blurhash += _base83(quantised_max, 1)
+    else:
+        max_value = 1
+        blurhash += _base83(0, 1)
+
+    r, g, b = (_linear_to_srgb(value) for value in dc)
+    blurhash += _base83((r << 16) + (g << 8) + b, 4)
+    for component in ac:
+        r, g, b = (
+            max(0, min(18, int(_sign_pow(value / max_value, 0.5) * 9 + 9.5)))
+            for value in component
+        )
+        blurhash += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return blurhash
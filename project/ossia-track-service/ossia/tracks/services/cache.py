@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+from pydantic import BaseModel
+
+meter = metrics.get_meter(__name__)
+
+hits_counter = meter.create_counter('cache_hits', '1', 'Lookups served from cache')
+misses_counter = meter.create_counter('cache_misses', '1', 'Lookups missed in cache')
+evictions_counter = meter.create_counter(
+    'cache_evictions', '1', 'Entries evicted to keep cache within its size'
+)
+
+
+class CachedObject(BaseModel):
+    data: bytes
+    etag: str
+    media_type: str
+
+
+class ObjectCache:
+    """
+    LRU cache of small S3 objects, bounded by total size of their bodies.
+    Objects larger than `max_item_bytes` are never cached, so one large
+    object can't flush many small hot ones
+    """
+
+    def __init__(self, name: str, max_bytes: int, max_item_bytes: int) -> None:
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self.size = 0
+        self._entries: OrderedDict[Hashable, CachedObject] = OrderedDict()
+
+        meter.create_observable_gauge(
+            'cache_size',
+            callbacks=[self._observe_size],
+            unit='By',
+            description='Total size of cached object bodies',
+        )
+
+    def _observe_size(self, options: CallbackOptions) -> Iterable[Observation]:
+        yield Observation(self.size, {'cache': self.name})
+
+    def get(self, key: Hashable) -> CachedObject | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            misses_counter.add(1, {'cache': self.name})
+            return None
+        self._entries.move_to_end(key)
+        hits_counter.add(1, {'cache': self.name})
+        return entry
+
+    def put(self, key: Hashable, entry: CachedObject) -> None:
+        if len(entry.data) > self.max_item_bytes:
+            return
+        self.pop(key)
+        self._entries[key] = entry
+        self.size += len(entry.data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.data)
+            evictions_counter.add(1, {'cache': self.name})
+
+    def pop(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.data)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,11 +1,22 @@
 import asyncio
 import enum
 import io
+import multiprocessing
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from typing import BinaryIO
 
-from PIL import Image
+from botocore.exceptions import ClientError
+from PIL import Image, features
+from pydantic import BaseModel
 
-from ossia.tracks.services.s3 import Buckets, S3Service
+from ossia.tracks.config import TracksServiceConfig
+from ossia.tracks.database.models import Tracks
+from ossia.tracks.services import blurhash
+from ossia.tracks.services.cache import CachedObject, ObjectCache
+from ossia.tracks.services.encode import FFMpegEncoder
+from ossia.tracks.services.s3 import Buckets, S3Client, S3Service
 
 
 class CoverFormats(enum.StrEnum):
@@ -13,7 +24,57 @@ class CoverFormats(enum.StrEnum):
     JPEG = 'JPEG'
 
 
+class CoverVariants(enum.StrEnum):
+    """
+    Formats covers are rendered to, smallest first
+    """
+
+    AVIF = 'avif'
+    WEBP = 'webp'
+    JPEG = 'jpg'
+
+    @property
+    def media_type(self) -> str:
+        if self == CoverVariants.JPEG:
+            return 'image/jpeg'
+        return f'image/{self}'
+
+    @property
+    def pil_format(self) -> str:
+        if self == CoverVariants.JPEG:
+            return 'JPEG'
+        return self.upper()
+
+
 SIZES = (256, 512, 1024, 2048, 3000)
+DEFAULT_SIZE = 256
+PALETTE_SIZE = 64
+VARIANT_OPTIONS: dict[CoverVariants, dict[str, int]] = {
+    # Default AVIF speed takes seconds per large cover
+    CoverVariants.AVIF: {'quality': 60, 'speed': 8},
+    CoverVariants.WEBP: {'quality': 80, 'method': 4},
+    CoverVariants.JPEG: {},
+}
+config = TracksServiceConfig()
+COVER_VARIANTS = tuple(
+    variant
+    for variant in CoverVariants
+    if variant != CoverVariants.AVIF or (config.cover_avif and features.check('avif'))
+)
+cover_cache = ObjectCache(
+    'covers', config.cover_cache_size, config.cover_cache_size // 16
+)
+_pool: ProcessPoolExecutor | None = None
+_rendering: dict[tuple[str, int], asyncio.Task[bool]] = {}
+
+
+class CoverPlaceholder(BaseModel):
+    """
+    Shown by clients until cover itself is loaded
+    """
+
+    color: str  # dominant colour as #rrggbb
+    blurhash: str
 
 
 def _crop(img: Image.Image) -> Image.Image:
@@ -28,9 +89,183 @@ def _crop(img: Image.Image) -> Image.Image:
     )
 
 
-async def _upload_cover(file: BinaryIO, key: str) -> None:
+def cover_key(track_id: str, size: int, variant: CoverVariants) -> str:
+    return f'{track_id}/cover{size}.{variant}'
+
+
+def cover_source_key(track_id: str) -> str:
+    return f'{track_id}/cover.source'
+
+
+def _encode(img: Image.Image) -> dict[CoverVariants, bytes]:
+    """
+    Encodes image to every variant, keeping only ones smaller than
+    all kept fallbacks, so the first variant client accepts is the smallest
+    """
+    encoded: dict[CoverVariants, bytes] = {}
+    for variant in reversed(COVER_VARIANTS):
+        out_file = io.BytesIO()
+        img.save(out_file, format=variant.pil_format, **VARIANT_OPTIONS[variant])
+        data = out_file.getvalue()
+        if not encoded or len(data) < min(map(len, encoded.values())):
+            encoded[variant] = data
+    return encoded
+
+
+def _placeholder(img: Image.Image) -> CoverPlaceholder:
+    palette = img.resize((PALETTE_SIZE, PALETTE_SIZE), Image.Resampling.BOX).quantize(
+        colors=8, method=Image.Quantize.MEDIANCUT
+    )
+    _, index = max(palette.getcolors() or [(0, 0)])
+    # Pixels of quantized image are palette indexes
+    assert isinstance(index, int)
+    r, g, b = (palette.getpalette() or [0, 0, 0])[index * 3 : index * 3 + 3]
+    return CoverPlaceholder(
+        color=f'#{r:02x}{g:02x}{b:02x}', blurhash=blurhash.encode(img)
+    )
+
+
+def _render_cover(
+        source: str | bytes, sizes: Sequence[int] = SIZES, placeholder: bool = False
+) -> tuple[dict[int, dict[CoverVariants, bytes]], CoverPlaceholder | None]:
+    """
+    Renders cover of given sizes in every variant, each size is downscaled
+    from the next larger one. Sizes above source resolution get
+    the source sized cover, it is never upscaled.
+    Placeholder is computed from the smallest one
+    """
+    file = source if isinstance(source, str) else io.BytesIO(source)
+    with Image.open(file, formats=(CoverFormats.PNG, CoverFormats.JPEG)) as img:
+        # JPEG is decoded with DCT scaling straight to the smallest scale
+        # still covering the largest size, no-op for other formats
+        img.draft('RGB', (max(sizes), max(sizes)))
+        current = _crop(img.convert('RGB'))
+
+    rendered: dict[int, dict[CoverVariants, bytes]] = {}
+    for size in sorted(sizes, reverse=True):
+        side = min(size, current.width)
+        if side != current.width:
+            current = current.resize((side, side))
+        if side not in rendered:
+            rendered[side] = _encode(current)
+        rendered[size] = rendered[side]
+    return (
+        {size: rendered[size] for size in sizes},
+        _placeholder(current) if placeholder else None,
+    )
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=config.cover_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _pool
+
+
+async def _upload_cover(
+        s3: S3Client, file: BinaryIO, key: str, content_type: str
+) -> None:
+    await s3.upload_fileobj(
+        file,
+        Bucket=Buckets.COVERS,
+        Key=key,
+        ExtraArgs={'ContentType': content_type},
+    )
+
+
+async def _upload_covers(
+        s3: S3Client, track_id: str, covers: dict[int, dict[CoverVariants, bytes]]
+) -> None:
+    async with asyncio.TaskGroup() as tg:
+        for size, variants in covers.items():
+            for variant, data in variants.items():
+                tg.create_task(
+                    _upload_cover(
+                        s3,
+                        io.BytesIO(data),
+                        key=cover_key(track_id, size, variant),
+                        content_type=variant.media_type,
+                    )
+                )
+
+
+async def resolve_cover(
+        track_id: str, size: int, preference: Sequence[CoverVariants]
+) -> CoverVariants | None:
+    """
+    Returns the first stored variant of the cover from given preference
+    without fetching its body, None if the size is not rendered
+    """
+    async with S3Service() as s3:
+        for variant in preference:
+            try:
+                await s3.head_object(
+                    Bucket=Buckets.COVERS, Key=cover_key(track_id, size, variant)
+                )
+            except ClientError:
+                # Covers processed before the variant was introduced
+                continue
+            return variant
+    return None
+
+
+async def fetch_cover(
+        track_id: str, size: int, preference: Sequence[CoverVariants]
+) -> CachedObject | None:
+    """
+    Fetches the first stored variant of the cover from given preference,
+    None if the size is not rendered
+    """
     async with S3Service() as s3:
-        await s3.upload_fileobj(file, Bucket=Buckets.COVERS, Key=key)
+        for variant in preference:
+            try:
+                res = await s3.get_object(
+                    Bucket=Buckets.COVERS, Key=cover_key(track_id, size, variant)
+                )
+            except s3.exceptions.NoSuchKey:
+                continue
+            return CachedObject(
+                data=await res['Body'].read(),
+                etag=res['ETag'],
+                media_type=variant.media_type,
+            )
+    return None
+
+
+async def _render_size(track_id: str, size: int) -> bool:
+    async with S3Service() as s3:
+        try:
+            res = await s3.get_object(
+                Bucket=Buckets.COVERS, Key=cover_source_key(track_id)
+            )
+        except s3.exceptions.NoSuchKey:
+            return False
+        source = await res['Body'].read()
+    covers, _ = await asyncio.get_running_loop().run_in_executor(
+        _get_pool(), _render_cover, source, (size,)
+    )
+    async with S3Service() as s3:
+        await _upload_covers(s3, track_id, covers)
+    return True
+
+
+async def render_cover(track_id: str, size: int) -> bool:
+    """
+    Renders missing cover size from the stored source.
+    Concurrent calls for the same size share one rendering.
+    Returns False if there is no source to render from
+    """
+    key = (track_id, size)
+    task = _rendering.get(key)
+    if task is None:
+        task = asyncio.create_task(_render_size(track_id, size))
+        _rendering[key] = task
+        task.add_done_callback(lambda _: _rendering.pop(key, None))
+    # Requester going away must not cancel rendering for the others
+    return await asyncio.shield(task)
 
 
 def probe_cover(file: BinaryIO) -> str | None:
@@ -40,13 +275,32 @@ def probe_cover(file: BinaryIO) -> str | None:
     return res
 
 
-async def process_cover(file: str, track_id: str) -> None:
-    img = Image.open(file, formats=(CoverFormats.PNG, CoverFormats.JPEG))
-    img = _crop(img)  # type: ignore[assignment]
-    async with asyncio.TaskGroup() as tg:
-        for size in SIZES:
-            key = f'{track_id}/cover{size}.jpg'
-            out_file = io.BytesIO()
-            img.resize((size, size)).save(out_file, format=CoverFormats.JPEG)
-            tg.create_task(_upload_cover(out_file, key=key))
-    img.close()
+async def process_cover(file: str | io.BytesIO, track_id: str) -> None:
+    """
+    Renders cover sizes in process pool, so large images don't block event loop,
+    and stores cover placeholder on the track.
+    In lazy mode only the default size is rendered, others are rendered
+    from stored source on first request
+    """
+    source = file if isinstance(file, str) else file.getvalue()
+    sizes = (DEFAULT_SIZE,) if config.cover_lazy else SIZES
+    covers, placeholder = await asyncio.get_running_loop().run_in_executor(
+        _get_pool(), _render_cover, source, sizes, True
+    )
+    assert placeholder
+    async with S3Service() as s3, asyncio.TaskGroup() as tg:
+        tg.create_task(_upload_covers(s3, track_id, covers))
+        if config.cover_lazy:
+            if isinstance(source, str):
+                source = await asyncio.to_thread(Path(source).read_bytes)
+            tg.create_task(
+                _upload_cover(
+                    s3,
+                    io.BytesIO(source),
+                    key=cover_source_key(track_id),
+                    content_type='application/octet-stream',
+                )
+            )
+    await Tracks.filter(id=FFMpegEncoder.decode_track_id(track_id)).update(
+        cover_color=placeholder.color, cover_blurhash=placeholder.blurhash
+    )
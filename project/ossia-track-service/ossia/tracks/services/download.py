@@ -1,36 +1,356 @@
 import asyncio
+import hashlib
+import logging
 import string
-import sys
-from collections.abc import AsyncGenerator
+import uuid
+from collections import deque
+from collections.abc import (
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+)
+from datetime import datetime
 
-from aiobotocore.response import StreamingBody
+from botocore.exceptions import ClientError
+from pydantic import BaseModel
+
+from ossia.tracks.config import TracksServiceConfig
+from ossia.tracks.database.models import Tracks
+from ossia.tracks.services.s3 import (
+    PART_SIZE,
+    Buckets,
+    MultipartUpload,
+    S3Client,
+    S3Service,
+)
+from ossia.tracks.services.zipstream import ObjectRead, ZipArchive, ZipEntry
 
 VALID_CHARS = '-_.()' + string.ascii_letters + string.digits
 CHUNK_SIZE = 512 * 1024  # 512 kb
+CURRENT_BUFFER_SIZE = 4 * CHUNK_SIZE
+HEAD_CONCURRENCY = 16
+CACHE_BUFFER_SIZE = 2 * PART_SIZE
 
+config = TracksServiceConfig()
+logger = logging.getLogger(__name__)
+_caching: set[asyncio.Task[None]] = set()
 
-async def create_files_zip(
-        files_amount: int, streams_gen: AsyncGenerator[tuple[str, StreamingBody], None]
+
+class _ByteBudget:
+    """
+    Limits total size of chunks buffered by all prefetched objects.
+    Object which is streamed right now can still buffer up to `current_limit`
+    of its own chunks when the others took the whole limit
+    """
+
+    def __init__(self, limit: int, current_limit: int) -> None:
+        self.limit = limit
+        self.current_limit = current_limit
+        self.used = 0
+        self._changed = asyncio.Condition()
+
+    async def acquire(self, prefetch: '_Prefetch', size: int) -> None:
+        def _fits() -> bool:
+            if self.used + size <= self.limit:
+                return True
+            return prefetch.current and prefetch.buffered + size <= self.current_limit
+
+        async with self._changed:
+            await self._changed.wait_for(_fits)
+            self.used += size
+            prefetch.buffered += size
+
+    async def release(self, prefetch: '_Prefetch', size: int) -> None:
+        async with self._changed:
+            self.used -= size
+            prefetch.buffered -= size
+            self._changed.notify_all()
+
+
+class ArchiveFile(BaseModel):
+    name: str
+    key: str
+    modified: datetime
+    crc: int | None = None
+    etag: str | None = None  # of object version `crc` belongs to
+
+
+class _Prefetch:
+    def __init__(
+            self,
+            s3: S3Client,
+            bucket: Buckets,
+            key: str,
+            start: int,
+            end: int,
+            budget: _ByteBudget,
+    ) -> None:
+        self.current = False
+        self.buffered = 0
+        self._budget = budget
+        self._chunks: asyncio.Queue[bytes | BaseException | None] = asyncio.Queue()
+        self._task = asyncio.create_task(self._fetch(s3, bucket, key, start, end))
+        self._task.add_done_callback(self._reraise)
+
+    async def _fetch(
+            self, s3: S3Client, bucket: Buckets, key: str, start: int, end: int
+    ) -> None:
+        try:
+            res = await s3.get_object(
+                Bucket=bucket, Key=key, Range=f'bytes={start}-{end - 1}'
+            )
+            body = res['Body']
+            try:
+                async for chunk in body.iter_chunks(CHUNK_SIZE):
+                    await self._budget.acquire(self, len(chunk))
+                    self._chunks.put_nowait(chunk)
+            finally:
+                body.close()
+        except (ClientError, asyncio.TimeoutError) as e:
+            self._chunks.put_nowait(e)
+        else:
+            self._chunks.put_nowait(None)
+
+    def _reraise(self, task: asyncio.Task[None]) -> None:
+        # Unexpected errors are passed to the consumer instead of hanging it
+        if not task.cancelled() and (error := task.exception()) is not None:
+            self._chunks.put_nowait(error)
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        while (chunk := await self._chunks.get()) is not None:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            await self._budget.release(self, len(chunk))
+            yield chunk
+
+    def cancel(self) -> None:
+        self._task.cancel()
+
+
+async def prefetch_objects(
+        s3: S3Client,
+        bucket: Buckets,
+        reads: Iterable[tuple[str, int, int]],
+        depth: int,
+        max_bytes: int,
+) -> AsyncGenerator[AsyncIterator[bytes], None]:
+    """
+    Yields chunks of (key, start, end) object ranges in their original order,
+    while up to `depth` next ranges are already being read into buffer
+    of at most `max_bytes`. The range streamed right now may add CURRENT_BUFFER_SIZE
+    """
+    budget = _ByteBudget(max_bytes, CURRENT_BUFFER_SIZE)
+    pending: deque[_Prefetch] = deque()
+    reads_iter = iter(reads)
+
+    def _fill() -> None:
+        while len(pending) < depth:
+            read = next(reads_iter, None)
+            if read is None:
+                return
+            pending.append(_Prefetch(s3, bucket, *read, budget))
+
+    try:
+        _fill()
+        while pending:
+            prefetch = pending[0]
+            prefetch.current = True
+            # Wakes up fetch of this object if it waits for budget
+            await budget.release(prefetch, 0)
+            yield prefetch.chunks()
+            pending.popleft()
+            _fill()
+    finally:
+        for prefetch in pending:
+            prefetch.cancel()
+
+
+def archive_fingerprint(tracks: Iterable[Tracks]) -> str:
+    """
+    Hashes everything archive of the tracks depends on. Renditions
+    are updated by queries which don't touch edited_at, so it's not enough
+    """
+    hasher = hashlib.sha256()
+    for track in tracks:
+        hasher.update(
+            f'{track.id.hex}\0{track.title}\0{track.audio_key}\0'
+            f'{track.content_hash}\0{track.edited_at.isoformat()}\n'.encode()
+        )
+    return hasher.hexdigest()
+
+
+def archive_key(creator_id: uuid.UUID, fingerprint: str) -> str:
+    return f'{creator_id.hex}/{fingerprint}.zip'
+
+
+async def cached_archive_size(key: str) -> int | None:
+    """
+    Returns size of finished archive, None if it isn't cached
+    """
+    async with S3Service() as s3:
+        try:
+            res = await s3.head_object(Bucket=Buckets.ARCHIVES, Key=key)
+        except ClientError:
+            return None
+    return res['ContentLength']
+
+
+async def stream_cached_archive(
+        key: str, start: int, end: int
 ) -> AsyncGenerator[bytes, None]:
-    proc = await asyncio.create_subprocess_shell(
-        f'{sys.executable} -u zipper.py',
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
+    async with S3Service() as s3:
+        res = await s3.get_object(
+            Bucket=Buckets.ARCHIVES, Key=key, Range=f'bytes={start}-{end - 1}'
+        )
+        body = res['Body']
+        try:
+            async for chunk in body.iter_chunks(CHUNK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+
+async def invalidate_archives(creator_id: uuid.UUID) -> None:
+    """
+    Deletes cached archives of the creator, they are stale once any track changes
+    """
+    async with S3Service() as s3:
+        paginator = s3.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(
+                Bucket=Buckets.ARCHIVES, Prefix=f'{creator_id.hex}/'
+        ):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects:
+                await s3.delete_objects(
+                    Bucket=Buckets.ARCHIVES,
+                    Delete={'Objects': objects, 'Quiet': True},  # type: ignore[typeddict-item]
+                )
+
+
+async def layout_archive(bucket: Buckets, files: list[ArchiveFile]) -> ZipArchive:
+    """
+    Lays out archive of the objects from their sizes, so it can be streamed
+    from any offset. Checksums of replaced objects are dropped
+    """
+    semaphore = asyncio.Semaphore(HEAD_CONCURRENCY)
+
+    async def _head(s3: S3Client, key: str) -> tuple[int, str]:
+        async with semaphore:
+            res = await s3.head_object(Bucket=bucket, Key=key)
+        return res['ContentLength'], res['ETag']
+
+    async with S3Service() as s3:
+        heads = await asyncio.gather(*[_head(s3, file.key) for file in files])
+    for file, (_, etag) in zip(files, heads):
+        if file.etag != etag:
+            file.crc, file.etag = None, etag
+    return ZipArchive(
+        [
+            ZipEntry(name=file.name, size=size, modified=file.modified, crc=file.crc)
+            for file, (size, _) in zip(files, heads)
+        ]
     )
-    if not (proc.stdin and proc.stdout):
-        return
-    proc.stdin.write(f'{files_amount}'.encode())
-    async for filename, body in streams_gen:
-        proc.stdin.write(b'\x00')
-        proc.stdin.write(filename.encode())
-        proc.stdin.write(b'\x00')
-        async for chunk in body.iter_chunks(CHUNK_SIZE):
-            proc.stdin.write(chunk)
-        await proc.stdin.drain()
-
-    proc.stdin.write_eof()
-    await proc.stdin.drain()
-    proc.stdin.close()
-    async for chunk in proc.stdout:
-        yield chunk
-    await proc.stdin.wait_closed()
+
+
+class _ArchiveCache:
+    """
+    Stores streamed archive into ARCHIVES bucket in background task.
+    Caching is dropped instead of holding the client back when S3 fails
+    or falls more than CACHE_BUFFER_SIZE behind
+    """
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self._buffered = 0
+        self._chunks: asyncio.Queue[bytes | None] = asyncio.Queue()
+        self._task = asyncio.create_task(self._upload())
+        # Upload outlives the response, so the task is referenced until it ends
+        _caching.add(self._task)
+        self._task.add_done_callback(_caching.discard)
+
+    async def _upload(self) -> None:
+        async with S3Service() as s3:
+            upload = MultipartUpload(s3, Buckets.ARCHIVES, self.key)
+            try:
+                await upload.start()
+                while (chunk := await self._chunks.get()) is not None:
+                    self._buffered -= len(chunk)
+                    await upload.write(chunk)
+                await upload.complete()
+            except asyncio.CancelledError:
+                await self._abort(upload)
+                raise
+            except Exception:
+                logger.exception('Failed to cache archive %s', self.key)
+                await self._abort(upload)
+
+    async def _abort(self, upload: MultipartUpload) -> None:
+        try:
+            await upload.abort()
+        except Exception:
+            logger.exception('Failed to abort upload of archive %s', self.key)
+
+    def write(self, chunk: bytes) -> None:
+        if self._task.done() or self._task.cancelling():
+            return
+        if self._buffered + len(chunk) > CACHE_BUFFER_SIZE:
+            logger.warning('Upload of archive %s fell behind, dropped it', self.key)
+            self.cancel()
+            return
+        self._buffered += len(chunk)
+        self._chunks.put_nowait(chunk)
+
+    def finish(self) -> None:
+        """
+        Lets upload complete once buffered chunks are written
+        """
+        self._chunks.put_nowait(None)
+
+    def cancel(self) -> None:
+        self._task.cancel()
+
+
+async def create_files_zip(
+        bucket: Buckets,
+        files: list[ArchiveFile],
+        archive: ZipArchive,
+        start: int = 0,
+        end: int | None = None,
+        cache_key: str | None = None,
+        on_checksum: Callable[[int, int], Awaitable[None]] | None = None,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Streams bytes [start, end) of archive laid out by `layout_archive`.
+    With `cache_key` the whole archive is also stored into ARCHIVES bucket
+    in background, unless client leaves before it is finished
+    """
+    end = archive.size if end is None else end
+    async with S3Service() as s3:
+
+        def _read_objects(
+                reads: list[ObjectRead],
+        ) -> AsyncGenerator[AsyncIterator[bytes], None]:
+            return prefetch_objects(
+                s3,
+                bucket,
+                [(files[read.index].key, read.start, read.end) for read in reads],
+                config.archive_prefetch,
+                config.archive_prefetch_bytes,
+            )
+
+        cache = None
+        if cache_key is not None and start == 0 and end == archive.size:
+            cache = _ArchiveCache(cache_key)
+        try:
+            async for chunk in archive.stream(_read_objects, start, end, on_checksum):
+                if cache is not None:
+                    cache.write(chunk)
+                yield chunk
+        except BaseException:
+            if cache is not None:
+                cache.cancel()
+            raise
+        if cache is not None:
+            cache.finish()
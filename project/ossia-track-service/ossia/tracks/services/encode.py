@@ -3,19 +3,38 @@ import base64
 import binascii
 import enum
 import io
+import logging
+import math
+import os
 import string
+import tempfile
 import uuid
-from collections.abc import Generator
+from collections.abc import Awaitable, Callable, Coroutine, Generator, Sequence
+from functools import partial
+from typing import Any
 
 import orjson
 import tortoise.exceptions
+from aiobotocore.response import StreamingBody
+from botocore.exceptions import ClientError
 from opentelemetry import trace
 from pydantic import BaseModel, ValidationError
 
-from ossia.tracks.database.models import Tracks
-from ossia.tracks.enum import TrackStatus
-from ossia.tracks.services.download import VALID_CHARS
-from ossia.tracks.services.s3 import Buckets, S3Service
+from ossia.tracks.config import TracksServiceConfig
+from ossia.tracks.database.models import ProcessingJobs, Tracks
+from ossia.tracks.enum import JobStep, TrackStatus
+from ossia.tracks.services.download import VALID_CHARS, invalidate_archives
+from ossia.tracks.services.process import (
+    PIPE_CHUNK_SIZE,
+    ExecProcess,
+    ProcessLimits,
+    command,
+    open_pipe_reader,
+    run_process,
+)
+from ossia.tracks.services.s3 import Buckets, MultipartUpload, S3Client, S3Service
+from ossia.tracks.services.scheduler import scheduler
+from ossia.tracks.services.waveform import PeaksAccumulator, upload_waveform
 
 
 class SupportedFormats(enum.StrEnum):
@@ -25,24 +44,81 @@ class SupportedFormats(enum.StrEnum):
 
 FFMPEG_FLAC_CMD = string.Template(
     # 'ffmpeg -f ${input_format} -i ${input_path} -map 0:a:0 -vn -dn -sn '
-    'ffmpeg -loglevel -8 -f ${input_format} -i ${input_path} -map 0:a:0 -vn -dn -sn '
+    'ffmpeg -loglevel error -nostats -f ${input_format} -i ${input_path} -map 0:a:0 -vn -dn -sn '
     '-af "silenceremove=stop_periods=1:stop_duration=1:stop_threshold=-90dB" '
     '-f flac ${output_path}'
 )
 FFMPEG_CMD = string.Template(
     # "ffmpeg -f ${input_format} -i ${input_path} -b:a ${bitrate}k -map 0:a:0 -vn -dn -sn "
-    'ffmpeg -loglevel -8 -f ${input_format} -i ${input_path} -b:a ${bitrate}k -map 0:a:0 -vn -dn -sn '
+    'ffmpeg -loglevel error -nostats -f ${input_format} -i ${input_path} -b:a ${bitrate}k -map 0:a:0 -vn -dn -sn '
     '-af "silenceremove=stop_periods=1:stop_duration=1:stop_threshold=-90dB" '
     '-f ogg ${output_path}'
 )
+FFMPEG_OPUS_CMD = string.Template(
+    'ffmpeg -loglevel error -nostats -f ${input_format} -i ${input_path} -map 0:a:0 -vn -dn -sn '
+    '-af "silenceremove=stop_periods=1:stop_duration=1:stop_threshold=-90dB" '
+    '-c:a libopus -b:a ${bitrate}k -ar 48000 -f ogg ${output_path}'
+)
+FFMPEG_SPLIT_CMD = string.Template(
+    'ffmpeg -loglevel error -nostats -f ${input_format} -i ${input_path} '
+    '-filter_complex "[0:a:0]silenceremove=stop_periods=1:stop_duration=1:stop_threshold=-90dB,'
+    'asplit=${outputs_amount}${labels}${filters}"'
+)
+FFMPEG_SPLIT_OGG_OUTPUT = string.Template(
+    '-map "[${label}]" -vn -dn -sn -b:a ${bitrate}k -f ogg ${output_path}'
+)
+FFMPEG_SPLIT_OPUS_OUTPUT = string.Template(
+    '-map "[${label}]" -vn -dn -sn -c:a libopus -b:a ${bitrate}k -ar 48000 '
+    '-f ogg ${output_path}'
+)
+FFMPEG_SPLIT_FLAC_OUTPUT = string.Template(
+    '-map "[${label}]" -vn -dn -sn -f flac ${output_path}'
+)
+FFMPEG_SPLIT_PCM_OUTPUT = string.Template(
+    '-map "[${label}]" -vn -dn -sn -ac 1 -c:a pcm_s16le -f s16le ${output_path}'
+)
+FFMPEG_SPLIT_LOUDNESS_FILTER = string.Template(
+    ';[${label}]ebur128=peak=true:metadata=1,'
+    'ametadata=mode=print:file=${output_path},anullsink'
+)
 FFPROBE_CMD = string.Template(
-    'ffprobe -loglevel -8 -of json -show_error -show_format -select_streams a:0 -i ${file_path}'
+    'ffprobe -loglevel error -of json -show_error -show_format -show_streams '
+    '-select_streams a:0 -i ${file_path}'
 )
-FFPROBE_BINARY_CMD = (
-    'ffprobe -loglevel -8 -of json -show_error -show_format -select_streams a:0 -i -'
+FFPROBE_BINARY_CMD = string.Template(
+    'ffprobe -loglevel error -of json -show_error -show_format -show_streams '
+    '-select_streams a:0 -i -'
 )
 BITRATES = (96, 160, 320)
+OPUS_BITRATES = (64, 96, 160)
+RENDITION_BITRATES = {
+    **dict(zip(Buckets.ogg_buckets(), BITRATES)),
+    **dict(zip(Buckets.opus_buckets(), OPUS_BITRATES)),
+}
+PROBE_SIZE = 1024 * 1024  # 1 MB
+# Metadata with embedded artwork can take several MB before audio begins
+MAX_PROBE_SIZE = 64 * 1024 * 1024  # 64 MB
+FINISHED_FIELDS = [
+    'duration',
+    'integrated_loudness',
+    'loudness_range',
+    'true_peak',
+    'audio_key',
+    'renditions',
+    'status',
+    'edited_at',
+]
 tracer = trace.get_tracer('ossia.ffmpeg')
+logger = logging.getLogger(__name__)
+config = TracksServiceConfig()
+ENCODE_LIMITS = ProcessLimits(
+    timeout=config.ffmpeg_timeout,
+    cpu_time=config.ffmpeg_cpu_limit,
+    memory=config.ffmpeg_memory_limit,
+)
+PROBE_LIMITS = ProcessLimits(
+    timeout=config.ffprobe_timeout, memory=config.ffmpeg_memory_limit
+)
 
 
 class FFmpegError(BaseModel):
@@ -60,22 +136,201 @@ class FFmpegFormat(BaseModel):
     probe_score: int
 
 
+class FFmpegStream(BaseModel):
+    codec_name: str | None = None
+    sample_rate: int | None = None
+    channels: int | None = None
+    channel_layout: str | None = None
+    duration: float | None = None
+
+
 class FFmpegResult(BaseModel):
     format: FFmpegFormat | None = None
+    streams: list[FFmpegStream] = []
     error: FFmpegError | None = None
 
 
+class Loudness(BaseModel):
+    """
+    EBU R128 loudness of encoded audio
+    """
+
+    integrated: float | None = None  # LUFS
+    range: float | None = None  # LU
+    true_peak: float | None = None  # dBTP
+
+
+class MediaInfo(BaseModel):
+    """
+    Probed audio metadata, passed from upload to encoding worker
+    """
+
+    format: SupportedFormats
+    duration: float | None = None
+    sample_rate: int | None = None
+    channels: int | None = None
+    channel_layout: str | None = None
+
+
+def _parse_probe(stdout: bytes) -> MediaInfo | None:
+    try:
+        result = FFmpegResult.model_validate(orjson.loads(stdout.decode()))
+    except (ValidationError, orjson.JSONDecodeError) as e:
+        raise RuntimeError(f'ffprobe returned invalid data:\n{stdout.decode()}\n{e}')
+    if result.error is not None:
+        raise RuntimeError(f'ffprobe failed: {result.error.code} {result.error.string}')
+    if result.format is None:
+        raise RuntimeError(f'ffprobe returned invalid data:\n{stdout.decode()}')
+
+    if result.format.format_name not in (SupportedFormats.FLAC, SupportedFormats.WAVE):
+        return None
+    stream = result.streams[0] if result.streams else FFmpegStream()
+    return MediaInfo(
+        format=SupportedFormats(result.format.format_name),
+        duration=result.format.duration or stream.duration,
+        sample_rate=stream.sample_rate,
+        channels=stream.channels,
+        channel_layout=stream.channel_layout,
+    )
+
+
+def _header_end(prefix: bytes) -> int | None:
+    """
+    Returns offset of audio data after FLAC metadata blocks or WAV chunks.
+    If they continue past `prefix`, returns the least offset they can end at.
+    None if prefix is neither FLAC nor WAV
+    """
+    if prefix.startswith(b'fLaC'):
+        offset = 4
+        while offset + 4 <= len(prefix):
+            header = int.from_bytes(prefix[offset:offset + 4], 'big')
+            offset += 4 + (header & 0xFFFFFF)
+            if header >> 31:  # last metadata block
+                return offset
+        return offset + 4
+    if prefix[:4] in (b'RIFF', b'RF64') and prefix[8:12] == b'WAVE':
+        offset = 12
+        while offset + 8 <= len(prefix):
+            chunk_id = prefix[offset:offset + 4]
+            size = int.from_bytes(prefix[offset + 4:offset + 8], 'little')
+            offset += 8
+            if chunk_id == b'data':
+                return offset
+            offset += size + size % 2
+        return offset + 8
+    return None
+
+
+def encode_buckets() -> tuple[Buckets, ...]:
+    """
+    Returns buckets of renditions produced by encoder, smallest first
+    """
+    if config.encode_opus:
+        return *Buckets.opus_buckets(), *Buckets.rendition_buckets()
+    return Buckets.rendition_buckets()
+
+
+async def _feed_stdin(stdin: asyncio.StreamWriter, body: StreamingBody) -> None:
+    try:
+        async for chunk in body.iter_chunks(PIPE_CHUNK_SIZE):
+            stdin.write(chunk)
+            await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg exited before reading the whole input, returncode will tell why
+        pass
+    finally:
+        stdin.close()
+
+
+async def _pump_to_s3(reader: asyncio.StreamReader, upload: MultipartUpload) -> None:
+    while chunk := await reader.read(PIPE_CHUNK_SIZE):
+        await upload.write(chunk)
+
+
+async def _collect_peaks(reader: asyncio.StreamReader, peaks: PeaksAccumulator) -> None:
+    while chunk := await reader.read(PIPE_CHUNK_SIZE):
+        peaks.feed(chunk)
+
+
+async def _collect_loudness(reader: asyncio.StreamReader, loudness: Loudness) -> None:
+    # ebur128 attaches running values to every 100ms frame, so the last
+    # integrated loudness and range are the ones of the whole track
+    true_peak = 0.0
+    async for line in reader:
+        key, _, value = line.decode().strip().partition('=')
+        try:
+            number = float(value)
+        except ValueError:
+            continue
+        if key == 'lavfi.r128.I':
+            loudness.integrated = number
+        elif key == 'lavfi.r128.LRA':
+            loudness.range = number
+        elif key == 'lavfi.r128.true_peak':
+            true_peak = max(true_peak, number)
+    if true_peak > 0:
+        loudness.true_peak = round(20 * math.log10(true_peak), 2)
+
+
+async def _read_progress(reader: asyncio.StreamReader) -> float | None:
+    duration = None
+    async for line in reader:
+        key, _, value = line.decode().strip().partition('=')
+        if key == 'out_time_us' and value.isdigit():
+            duration = int(value) / 1_000_000
+    return duration
+
+
+class _PipeOutput:
+    """
+    Extra ffmpeg output written to pipe and read by consumer coroutine
+    """
+
+    def __init__(
+            self,
+            consumer: Callable[[asyncio.StreamReader], Coroutine[Any, Any, object]],
+    ) -> None:
+        self.consumer = consumer
+        self.read_fd, self.write_fd = os.pipe()
+
+    @property
+    def path(self) -> str:
+        return f'pipe:{self.write_fd}'
+
+    @property
+    def device(self) -> str:
+        # For filters, which open output by file name rather than ffmpeg protocol
+        return f'/dev/fd/{self.write_fd}'
+
+
 class FFMpegEncoder:
-    path: str
-    dir: str
+    path: str | None
+    dir: str | None
     encoded: str
     uuid_: uuid.UUID
-
-    def __init__(self, tmp_path: str, file_path: str, track_id: str):
-        assert isinstance(file_path, str), 'Only str is are accepted for file_path'
-        assert isinstance(tmp_path, str), 'Only str is accepted for tmp_path'
+    media: MediaInfo | None
+
+    def __init__(
+            self,
+            track_id: str,
+            tmp_path: str | None = None,
+            file_path: str | None = None,
+            media: MediaInfo | None = None,
+    ):
+        assert file_path is None or isinstance(file_path, str), (
+            'Only str is are accepted for file_path'
+        )
+        assert tmp_path is None or isinstance(tmp_path, str), (
+            'Only str is accepted for tmp_path'
+        )
         self.path = file_path
         self.dir = tmp_path
+        self.media = media
+        self._ready: list[Buckets] = []
+        self._ready_lock = asyncio.Lock()
+        self._job: ProcessingJobs | None = None
+        self.peaks = PeaksAccumulator()
+        self.loudness = Loudness()
 
         self.encoded = track_id
         self.uuid_ = self.decode_track_id(track_id)
@@ -99,61 +354,114 @@ class FFMpegEncoder:
         except ValueError as e:
             raise e
 
-    async def probe(self) -> tuple[bool, SupportedFormats | None, int | float]:
-        proc = await asyncio.subprocess.create_subprocess_shell(
-            FFPROBE_CMD.substitute(file_path=self.path), stdout=asyncio.subprocess.PIPE
+    async def probe(self) -> MediaInfo | None:
+        # ffprobe exits with error on unreadable input, which is reported in its output
+        result = await run_process(
+            command(FFPROBE_CMD, file_path=self.path), limits=PROBE_LIMITS, check=False
         )
-        stdout, _ = await proc.communicate()
-        try:
-            result = FFmpegResult.model_validate(orjson.loads(stdout.decode()))
-        except (ValidationError, orjson.JSONDecodeError) as e:
-            raise RuntimeError(
-                f'ffprobe returned invalid data:\n{stdout.decode()}\n{e}'
-            )
-        if result.error is not None:
-            raise RuntimeError(
-                f'ffprobe failed: {result.error.code} {result.error.string}'
-            )
-        if result.format is None:
-            raise RuntimeError(f'ffprobe returned invalid data:\n{stdout.decode()}')
+        return _parse_probe(result.stdout)
+
+    @staticmethod
+    async def probe_binary(file: io.BytesIO) -> MediaInfo | None:
+        result = await run_process(
+            command(FFPROBE_BINARY_CMD),
+            input=file.getbuffer(),
+            limits=PROBE_LIMITS,
+            check=False,
+        )
+        return _parse_probe(result.stdout)
+
+    @classmethod
+    async def probe_prefix(
+            cls, read_prefix: Callable[[int], Awaitable[bytes]]
+    ) -> tuple[MediaInfo | None, bytes]:
+        """
+        Probes source by its first bytes, which are read until they hold whole
+        FLAC metadata or WAV header and PROBE_SIZE of audio after it.
+        `read_prefix` returns given number of first bytes, fewer only at the end.
+        Returns probe result and bytes which were read
+        """
+        requested = PROBE_SIZE
+        while True:
+            prefix = await read_prefix(requested)
+            header_end = _header_end(prefix)
+            if header_end is None:
+                return None, prefix
+            needed = header_end + PROBE_SIZE
+            if needed <= len(prefix) or len(prefix) < requested:
+                break
+            if needed > MAX_PROBE_SIZE:
+                return None, prefix
+            requested = needed
+        return await cls.probe_binary(io.BytesIO(prefix)), prefix
 
-        assert result.format.duration
+    @classmethod
+    async def probe_object(
+            cls, s3: S3Client, bucket: Buckets, key: str
+    ) -> MediaInfo | None:
+        async def _read_prefix(size: int) -> bytes:
+            res = await s3.get_object(
+                Bucket=bucket, Key=key, Range=f'bytes=0-{size - 1}'
+            )
+            return await res['Body'].read()
 
-        match result.format.format_name:
-            case SupportedFormats.FLAC:
-                return True, SupportedFormats.FLAC, result.format.duration
-            case SupportedFormats.WAVE:
-                assert result.format.bit_rate
-                return True, SupportedFormats.WAVE, result.format.duration
-        return False, None, -1
+        media, _ = await cls.probe_prefix(_read_prefix)
+        return media
 
     @staticmethod
-    async def probe_binary(file: io.BytesIO) -> tuple[bool, SupportedFormats | None]:
-        proc = await asyncio.subprocess.create_subprocess_shell(
-            FFPROBE_BINARY_CMD,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-        )
-        stdout, _ = await proc.communicate(input=file.getbuffer())
+    async def _run(
+            argv: list[str],
+            weight: int = 1,
+            stdin: StreamingBody | None = None,
+            pipes: Sequence[_PipeOutput] = (),
+    ) -> float | None:
+        """
+        Runs ffmpeg in encode slot and returns duration of its output.
+        Source may be fed through stdin and extra outputs are consumed from pipes,
+        which are closed in any case. Progress is reported through a pipe too,
+        so stderr holds only errors
+        """
+        progress = _PipeOutput(_read_progress)
+        pipes = [progress, *pipes]
+        argv = [argv[0], '-progress', progress.path, *argv[1:]]
+        transports: list[asyncio.BaseTransport] = []
+        unowned_fds = [fd for pipe in pipes for fd in (pipe.read_fd, pipe.write_fd)]
         try:
-            result = FFmpegResult.model_validate(orjson.loads(stdout.decode()))
-        except (ValidationError, orjson.JSONDecodeError) as e:
-            raise RuntimeError(
-                f'ffprobe returned invalid data:\n{stdout.decode()}\n{e}'
-            )
-        if result.error is not None:
-            raise RuntimeError(
-                f'ffprobe failed: {result.error.code} {result.error.string}'
-            )
-        if result.format is None:
-            raise RuntimeError(f'ffprobe returned invalid data:\n{stdout.decode()}')
+            async with (
+                scheduler.slot(weight=weight),
+                ExecProcess(
+                    argv,
+                    ENCODE_LIMITS,
+                    wrapper=scheduler.wrapper(),
+                    pass_fds=[pipe.write_fd for pipe in pipes],
+                    stdin=stdin is not None,
+                ) as proc,
+            ):
+                for pipe in pipes:
+                    unowned_fds.remove(pipe.write_fd)
+                    os.close(pipe.write_fd)
+
+                readers = []
+                for pipe in pipes:
+                    unowned_fds.remove(pipe.read_fd)
+                    reader, transport = await open_pipe_reader(pipe.read_fd)
+                    readers.append(reader)
+                    transports.append(transport)
 
-        match result.format.format_name:
-            case SupportedFormats.FLAC:
-                return True, SupportedFormats.FLAC
-            case SupportedFormats.WAVE:
-                return True, SupportedFormats.WAVE
-        return False, None
+                async with asyncio.TaskGroup() as tg:
+                    if stdin is not None:
+                        assert proc.stdin
+                        tg.create_task(_feed_stdin(proc.stdin, stdin))
+                    duration = tg.create_task(_read_progress(readers[0]))
+                    for pipe, reader in zip(pipes[1:], readers[1:]):
+                        tg.create_task(pipe.consumer(reader))
+                await proc.wait()
+        finally:
+            for fd in unowned_fds:
+                os.close(fd)
+            for transport in transports:
+                transport.close()
+        return duration.result()
 
     async def convert_to_ogg(
             self, input_format: SupportedFormats, bitrate: int, bucket: Buckets
@@ -162,72 +470,436 @@ class FFMpegEncoder:
         if bucket not in Buckets.ogg_buckets():
             raise ValueError('Invalid bucket argument for OGG file')
 
-        proc = await asyncio.create_subprocess_shell(
-            FFMPEG_CMD.substitute(
+        await self._run(
+            command(
+                FFMPEG_CMD,
                 input_format=input_format,
                 input_path=self.path,
                 bitrate=bitrate,
                 output_path=key,
             )
         )
-        await proc.wait()
-        if proc.returncode != 0:
-            raise RuntimeError(f'ffmpeg failed: {proc.returncode}')
         return key
 
-    async def convert_to_flac(self, input_format: SupportedFormats) -> str:
-        key = f'{self.dir}/raw.flac'
-        proc = await asyncio.create_subprocess_shell(
-            FFMPEG_FLAC_CMD.substitute(
-                input_format=input_format, input_path=self.path, output_path=key
+    async def convert_to_opus(
+            self, input_format: SupportedFormats, bitrate: int, bucket: Buckets
+    ) -> str:
+        key = f'{self.dir}/{bitrate}.opus'
+        if bucket not in Buckets.opus_buckets():
+            raise ValueError('Invalid bucket argument for Opus file')
+
+        await self._run(
+            command(
+                FFMPEG_OPUS_CMD,
+                input_format=input_format,
+                input_path=self.path,
+                bitrate=bitrate,
+                output_path=key,
             )
         )
-        await proc.wait()
-        if proc.returncode != 0:
-            raise RuntimeError(f'ffmpeg failed: {proc.returncode}')
         return key
 
-    async def process(self) -> None:
-        with tracer.start_as_current_span('ffmpeg.process'):
+    async def convert_to_flac(
+            self, input_format: SupportedFormats
+    ) -> tuple[str, float | None]:
+        key = f'{self.dir}/raw.flac'
+        duration = await self._run(
+            command(
+                FFMPEG_FLAC_CMD,
+                input_format=input_format,
+                input_path=self.path,
+                output_path=key,
+            )
+        )
+        return key, duration
+
+    @staticmethod
+    def _split_cmd(
+            input_format: SupportedFormats,
+            input_path: str,
+            targets: dict[Buckets, str],
+            wave: _PipeOutput,
+            loudness: _PipeOutput,
+    ) -> list[str]:
+        labels: list[str] = []
+        outputs: list[str] = []
+        for bucket, output_path in targets.items():
+            labels.append(f'[{bucket}]')
+            if bucket == Buckets.RAW_TRACKS:
+                outputs += command(
+                    FFMPEG_SPLIT_FLAC_OUTPUT, label=bucket, output_path=output_path
+                )
+            elif bucket in Buckets.opus_buckets():
+                outputs += command(
+                    FFMPEG_SPLIT_OPUS_OUTPUT,
+                    label=bucket,
+                    bitrate=RENDITION_BITRATES[bucket],
+                    output_path=output_path,
+                )
+            else:
+                outputs += command(
+                    FFMPEG_SPLIT_OGG_OUTPUT,
+                    label=bucket,
+                    bitrate=RENDITION_BITRATES[bucket],
+                    output_path=output_path,
+                )
+        outputs += command(
+            FFMPEG_SPLIT_PCM_OUTPUT, label='wave', output_path=wave.path
+        )
+        labels += ['[wave]', '[loud]']
+        return [
+            *command(
+                FFMPEG_SPLIT_CMD,
+                input_format=input_format,
+                input_path=input_path,
+                outputs_amount=len(labels),
+                labels=''.join(labels),
+                filters=FFMPEG_SPLIT_LOUDNESS_FILTER.substitute(
+                    label='loud', output_path=loudness.device
+                ),
+            ),
+            *outputs,
+        ]
+
+    async def convert_all(
+            self, input_format: SupportedFormats, buckets: Sequence[Buckets]
+    ) -> tuple[dict[Buckets, str], float | None]:
+        """
+        Decodes source and applies filters only once, then splits the stream
+        inside a single ffmpeg filter graph into renditions for given buckets,
+        mono PCM for waveform peaks and EBU R128 loudness meter.
+        Returns paths of encoded files by bucket and duration of encoded audio
+        """
+        assert self.path, 'File path is required for file processing'
+        paths = {
+            bucket: f'{self.dir}/{bucket}.{bucket.extension}' for bucket in buckets
+        }
+        wave = _PipeOutput(partial(_collect_peaks, peaks=self.peaks))
+        loudness = _PipeOutput(partial(_collect_loudness, loudness=self.loudness))
+        duration = await self._run(
+            self._split_cmd(input_format, self.path, paths, wave, loudness),
+            weight=len(buckets),
+            pipes=[wave, loudness],
+        )
+        return paths, duration
+
+    async def stream_all(
+            self,
+            input_format: SupportedFormats,
+            body: StreamingBody,
+            s3: S3Client,
+            buckets: Sequence[Buckets],
+    ) -> float | None:
+        """
+        Same as convert_all, but source is read from S3 body through stdin and
+        lossy renditions are written to their own pipes straight into S3 multipart
+        uploads. FLAC is spooled to temp file, because ffmpeg fills its STREAMINFO
+        (total samples and MD5) by seeking back once encoding is finished.
+        Returns duration of encoded audio reported by ffmpeg
+        """
+        uploads = {
+            bucket: MultipartUpload(s3, bucket, self._rendition_key(bucket))
+            for bucket in buckets
+            if bucket != Buckets.RAW_TRACKS
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            flac_path = os.path.join(tmp, self._rendition_key(Buckets.RAW_TRACKS))
             try:
-                (is_supported, probed_format, _), record = await asyncio.gather(
-                    self.probe(), Tracks.get(id=self.uuid_)
+                await asyncio.gather(*[upload.start() for upload in uploads.values()])
+                pipes = {
+                    bucket: _PipeOutput(partial(_pump_to_s3, upload=upload))
+                    for bucket, upload in uploads.items()
+                }
+                targets = {
+                    bucket: pipes[bucket].path if bucket in pipes else flac_path
+                    for bucket in buckets
+                }
+                wave = _PipeOutput(partial(_collect_peaks, peaks=self.peaks))
+                loudness = _PipeOutput(
+                    partial(_collect_loudness, loudness=self.loudness)
+                )
+                duration = await self._run(
+                    self._split_cmd(input_format, 'pipe:0', targets, wave, loudness),
+                    weight=len(buckets),
+                    stdin=body,
+                    pipes=[*pipes.values(), wave, loudness],
                 )
-            except tortoise.exceptions.DoesNotExist:
-                raise ValueError(f'Track {self.uuid_} does not exist')
+                async with asyncio.TaskGroup() as tg:
+                    for bucket, upload in uploads.items():
+                        tg.create_task(self._complete_upload(upload, bucket))
+                    if Buckets.RAW_TRACKS in buckets:
+                        tg.create_task(
+                            self._upload_file(s3, flac_path, Buckets.RAW_TRACKS)
+                        )
+            except BaseException:
+                await asyncio.gather(
+                    *[upload.abort() for upload in uploads.values()],
+                    return_exceptions=True,
+                )
+                raise
+        return duration
 
-            if not is_supported or not probed_format:
+    async def _get_record(self) -> Tracks:
+        try:
+            return await Tracks.get(id=self.uuid_)
+        except tortoise.exceptions.DoesNotExist:
+            raise ValueError(f'Track {self.uuid_} does not exist')
+
+    async def _get_job(self) -> ProcessingJobs:
+        job, _ = await ProcessingJobs.get_or_create(id=self.uuid_)
+        job.attempts += 1
+        await job.save(update_fields=['attempts'])
+        if self.media is None and job.media is not None:
+            self.media = MediaInfo.model_validate(job.media)
+        return job
+
+    def _rendition_key(self, bucket: Buckets) -> str:
+        return f'{self.encoded}.{bucket.extension}'
+
+    async def _is_uploaded(self, s3: S3Client, bucket: Buckets) -> bool:
+        assert self._job
+        state = self._job.renditions.get(bucket)
+        if state is None or state['step'] != JobStep.UPLOADED:
+            return False
+        try:
+            res = await s3.head_object(Bucket=bucket, Key=self._rendition_key(bucket))
+        except ClientError:
+            return False
+        return res['ETag'] == state['etag']
+
+    async def _start_job(self, s3: S3Client) -> list[Buckets]:
+        """
+        Records probe result and returns buckets of renditions left to be encoded.
+        Renditions uploaded by previous attempts are kept only if their
+        S3 objects still have recorded checksum
+        """
+        assert self._job and self.media
+        buckets = encode_buckets()
+        uploaded = await asyncio.gather(
+            *[self._is_uploaded(s3, bucket) for bucket in buckets]
+        )
+        self._ready = [bucket for bucket, done in zip(buckets, uploaded) if done]
+        pending = [bucket for bucket, done in zip(buckets, uploaded) if not done]
+
+        self._job.media = self.media.model_dump(mode='json')
+        for bucket in pending:
+            self._job.renditions[str(bucket)] = {'step': JobStep.PROBED, 'etag': None}
+        await self._job.save(update_fields=['media', 'renditions'])
+        return pending
+
+    async def _set_step(
+            self, bucket: Buckets, step: JobStep, etag: str | None = None
+    ) -> None:
+        assert self._job
+        self._job.renditions[str(bucket)] = {'step': step, 'etag': etag}
+        await self._job.save(update_fields=['renditions'])
+
+    async def process(self) -> None:
+        assert self.path and self.dir, 'File paths are required for file processing'
+        with tracer.start_as_current_span('ffmpeg.process'):
+            record, self._job = await asyncio.gather(
+                self._get_record(), self._get_job()
+            )
+            if self.media is None:
+                self.media = await self.probe()
+            if self.media is None:
                 raise ValueError('This file is not supported')
             record.status = TrackStatus.PROCESSING
-            await record.save()
-            oggs = await asyncio.gather(
-                *[
-                    self.convert_to_ogg(probed_format, bitrate, bucket)
-                    for bitrate, bucket in zip(BITRATES, Buckets.ogg_buckets())
-                ]
+            await record.save(update_fields=['status', 'edited_at'])
+            async with S3Service() as s3:
+                pending = await self._start_job(s3)
+                if config.encode_single_pass:
+                    first = self._fast_rendition(pending)
+                    async with asyncio.TaskGroup() as tg:
+                        if first is not None:
+                            pending.remove(first)
+                            tg.create_task(self._convert_and_upload_ogg(s3, first))
+                        converted = tg.create_task(
+                            self._convert_all_and_upload(s3, pending)
+                        )
+                    duration = converted.result()
+                else:
+                    flac = None
+                    async with asyncio.TaskGroup() as tg:
+                        analysis = tg.create_task(self._analyze_and_upload_waveform(s3))
+                        for bucket in pending:
+                            if bucket == Buckets.RAW_TRACKS:
+                                flac = tg.create_task(self._convert_and_upload_flac(s3))
+                            else:
+                                tg.create_task(self._convert_and_upload_ogg(s3, bucket))
+                    duration = flac.result() if flac is not None else None
+                    if duration is None:
+                        duration = analysis.result()
+
+            await self._finish(record, duration)
+
+    async def process_stream(self, audio_key: str) -> None:
+        """
+        Variant of process which doesn't download source: it is streamed from
+        BUFFER bucket into ffmpeg and lossy renditions are streamed back to S3
+        """
+        with tracer.start_as_current_span('ffmpeg.process_stream'):
+            record, self._job = await asyncio.gather(
+                self._get_record(), self._get_job()
             )
-
             async with S3Service() as s3:
-                flac_path = await self.convert_to_flac(probed_format)
-                (_, _, duration), _ = await asyncio.gather(
-                    FFMpegEncoder(
-                        tmp_path=self.dir, file_path=flac_path, track_id=self.encoded
-                    ).probe(),
-                    s3.upload_file(
-                        flac_path, Bucket=Buckets.RAW_TRACKS, Key=f'{self.encoded}.flac'
-                    ),
-                )
-                record.duration = round(duration)
+                if self.media is None:
+                    self.media = await self.probe_object(s3, Buckets.BUFFER, audio_key)
+                if self.media is None:
+                    raise ValueError('This file is not supported')
+                record.status = TrackStatus.PROCESSING
+                await record.save(update_fields=['status', 'edited_at'])
+
+                pending = await self._start_job(s3)
+                first = self._fast_rendition(pending)
                 async with asyncio.TaskGroup() as tg:
-                    for path, bucket in zip(oggs, Buckets.ogg_buckets()):
-                        tg.create_task(
-                            s3.upload_file(
-                                path, Bucket=bucket, Key=f'{self.encoded}.ogg'
-                            )
-                        )
+                    if first is not None:
+                        pending.remove(first)
+                        tg.create_task(self._stream_rendition(s3, audio_key, first))
+                    source = await s3.get_object(Bucket=Buckets.BUFFER, Key=audio_key)
+                    streamed = tg.create_task(
+                        self.stream_all(self.media.format, source['Body'], s3, pending)
+                    )
+                duration = streamed.result()
+                await upload_waveform(s3, self.encoded, *self.peaks.finish())
+
+            await self._finish(record, duration)
+
+    def _fast_rendition(self, pending: list[Buckets]) -> Buckets | None:
+        """
+        Picks smallest Vorbis rendition to be encoded by its own ffmpeg run ahead
+        of the others, so track becomes playable without waiting for the whole
+        split pass. Vorbis is used because every client can play it
+        """
+        if not config.encode_fast_first or len(pending) < 2:
+            return None
+        if any(bucket in Buckets.ogg_buckets() for bucket in self._ready):
+            return None
+        for bucket in Buckets.ogg_buckets():
+            if bucket in pending:
+                return bucket
+        return None
+
+    async def _finish(self, record: Tracks, duration: float | None) -> None:
+        assert self._job
+        self._set_duration(record, duration)
+        record.integrated_loudness = self.loudness.integrated
+        record.loudness_range = self.loudness.range
+        record.true_peak = self.loudness.true_peak
+        record.audio_key = self.encoded
+        record.renditions = list(self._ready)
+        record.status = TrackStatus.READY
+        # Cover is processed concurrently, so its fields must not be overwritten
+        await record.save(update_fields=FINISHED_FIELDS)
+        await self._job.delete()
+        try:
+            await invalidate_archives(record.creator_id)
+        except Exception:
+            # Track is ready anyway, stale archive is only served until next change
+            logger.exception('Failed to invalidate archives of %s', record.creator_id)
+
+    async def _publish(self, bucket: Buckets, etag: str) -> None:
+        """
+        Marks rendition as ready, so it can be played before the whole job ends
+        """
+        async with self._ready_lock:
+            await self._set_step(bucket, JobStep.UPLOADED, etag)
+            self._ready.append(bucket)
+            await Tracks.filter(id=self.uuid_).update(
+                audio_key=self.encoded, renditions=list(self._ready)
+            )
 
-            record.status = TrackStatus.READY
-            await record.save()
+    async def _upload_file(self, s3: S3Client, path: str, bucket: Buckets) -> None:
+        key = self._rendition_key(bucket)
+        await s3.upload_file(path, Bucket=bucket, Key=key)
+        res = await s3.head_object(Bucket=bucket, Key=key)
+        await self._publish(bucket, res['ETag'])
+
+    async def _complete_upload(self, upload: MultipartUpload, bucket: Buckets) -> None:
+        etag = await upload.complete()
+        await self._publish(bucket, etag)
+
+    async def _convert_and_upload_ogg(self, s3: S3Client, bucket: Buckets) -> None:
+        assert self.media
+        if bucket in Buckets.opus_buckets():
+            convert = self.convert_to_opus
+        else:
+            convert = self.convert_to_ogg
+        path = await convert(self.media.format, RENDITION_BITRATES[bucket], bucket)
+        async with self._ready_lock:
+            await self._set_step(bucket, JobStep.ENCODED)
+        await self._upload_file(s3, path, bucket)
+
+    async def _convert_all_and_upload(
+            self, s3: S3Client, buckets: Sequence[Buckets]
+    ) -> float | None:
+        assert self.media
+        paths, duration = await self.convert_all(self.media.format, buckets)
+        async with self._ready_lock:
+            for bucket in paths:
+                await self._set_step(bucket, JobStep.ENCODED)
+        # Cheapest renditions are the smallest ones, so they are
+        # uploaded and published first
+        async with asyncio.TaskGroup() as tg:
+            for bucket, path in paths.items():
+                tg.create_task(self._upload_file(s3, path, bucket))
+            tg.create_task(upload_waveform(s3, self.encoded, *self.peaks.finish()))
+        return duration
+
+    async def _stream_rendition(
+            self, s3: S3Client, audio_key: str, bucket: Buckets
+    ) -> None:
+        """
+        Streams source from BUFFER bucket through ffmpeg into a single
+        Vorbis rendition, which is published as soon as it is uploaded
+        """
+        assert self.media
+        source = await s3.get_object(Bucket=Buckets.BUFFER, Key=audio_key)
+        upload = MultipartUpload(s3, bucket, self._rendition_key(bucket))
+        try:
+            await upload.start()
+            pipe = _PipeOutput(partial(_pump_to_s3, upload=upload))
+            await self._run(
+                command(
+                    FFMPEG_CMD,
+                    input_format=self.media.format,
+                    input_path='pipe:0',
+                    bitrate=RENDITION_BITRATES[bucket],
+                    output_path=pipe.path,
+                ),
+                stdin=source['Body'],
+                pipes=[pipe],
+            )
+            async with self._ready_lock:
+                await self._set_step(bucket, JobStep.ENCODED)
+            await self._complete_upload(upload, bucket)
+        except BaseException:
+            await asyncio.gather(upload.abort(), return_exceptions=True)
+            raise
+
+    async def _convert_and_upload_flac(self, s3: S3Client) -> float | None:
+        assert self.media
+        path, duration = await self.convert_to_flac(self.media.format)
+        async with self._ready_lock:
+            await self._set_step(Buckets.RAW_TRACKS, JobStep.ENCODED)
+        await self._upload_file(s3, path, Buckets.RAW_TRACKS)
+        return duration
+
+    async def _analyze_and_upload_waveform(self, s3: S3Client) -> float | None:
+        """
+        Measures loudness and waveform peaks in a pass without renditions,
+        used when renditions are encoded by separate ffmpeg runs
+        """
+        assert self.media
+        _, duration = await self.convert_all(self.media.format, [])
+        await upload_waveform(s3, self.encoded, *self.peaks.finish())
+        return duration
+
+    def _set_duration(self, record: Tracks, duration: float | None) -> None:
+        if duration is None and self.media is not None:
+            duration = self.media.duration
+        if duration is not None:
+            record.duration = round(duration)
 
 
 def sanitize_title(title: str) -> str:
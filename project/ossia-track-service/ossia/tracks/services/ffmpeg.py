@@ -1,4 +1,4 @@
-import asyncio.subprocess
+import asyncio
 import base64
 import binascii
 import enum
@@ -13,6 +13,7 @@ from pydantic import BaseModel, ValidationError, model_validator
 from ossia.tracks.database.models import Tracks
 from ossia.tracks.enum import TrackStatus
 from ossia.tracks.services.download import VALID_CHARS
+from ossia.tracks.services.process import command, run_process
 from ossia.tracks.services.s3 import Buckets, S3Service
 
 
@@ -60,7 +61,7 @@ FFMPEG_CMD = string.Template(
     '-af "silenceremove=stop_periods=1:stop_duration=1:stop_threshold=-90dB" '
     '-c:a ogg -f flac -'
 )
-FFPROBE_CMD = (
+FFPROBE_CMD = string.Template(
     'ffprobe -loglevel -8 -of json -show_error -show_format -select_streams a:0 -i -'
 )
 BITRATES = (96, 160, 320)
@@ -106,10 +107,11 @@ class FFmpegController:
             raise e
 
     async def probe(self) -> tuple[bool, SupportedFormats | None, int | float]:
-        proc = await asyncio.subprocess.create_subprocess_shell(
-            FFPROBE_CMD, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
-        )
-        stdout, _ = await proc.communicate(input=self._file.getbuffer())
+        stdout = (
+            await run_process(
+                command(FFPROBE_CMD), input=self._file.getbuffer(), check=False
+            )
+        ).stdout
         try:
             result = FFmpegResult.model_validate(orjson.loads(stdout.decode()))
         except (ValidationError, orjson.JSONDecodeError) as e:
@@ -136,26 +138,18 @@ class FFmpegController:
         if bucket not in Buckets.ogg_buckets():
             raise ValueError('Invalid bucket argument for OGG file')
 
-        proc = await asyncio.create_subprocess_shell(
-            FFMPEG_CMD.substitute(input_format=input_format, bitrate=bitrate),
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
+        result = await run_process(
+            command(FFMPEG_CMD, input_format=input_format, bitrate=bitrate),
+            input=self._file.getbuffer(),
         )
-        stdout, _ = await proc.communicate(input=self._file.getbuffer())
-        if proc.returncode != 0:
-            raise RuntimeError('ffmpeg failed')
-        return stdout
+        return result.stdout
 
     async def convert_to_flac(self, input_format: SupportedFormats):
-        proc = await asyncio.create_subprocess_shell(
-            FFMPEG_FLAC_CMD.substitute(input_format=input_format),
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
+        result = await run_process(
+            command(FFMPEG_FLAC_CMD, input_format=input_format),
+            input=self._file.getbuffer(),
         )
-        stdout, _ = await proc.communicate(input=self._file.getbuffer())
-        if proc.returncode != 0:
-            raise RuntimeError('ffmpeg failed')
-        return stdout
+        return result.stdout
 
     async def process(self):
         with tracer.start_as_current_span('ffmpeg.process'):
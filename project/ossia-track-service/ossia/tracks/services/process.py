@@ -0,0 +1,309 @@
+import asyncio
+import os
+import resource
+import shlex
+import signal
+import string
+import subprocess
+from collections.abc import Sequence
+from functools import partial
+from types import TracebackType
+from typing import Self
+
+from opentelemetry import metrics
+from pydantic import BaseModel
+
+PIPE_CHUNK_SIZE = 256 * 1024  # 256 kb
+STDERR_TAIL_SIZE = 4096
+# Soft RLIMIT_CPU sends SIGXCPU, hard one kills process which survived it
+CPU_LIMIT_GRACE = 5
+
+meter = metrics.get_meter(__name__)
+
+cpu_time_histogram = meter.create_histogram(
+    'subprocess_cpu_time', 's', 'CPU time used by child process'
+)
+max_rss_histogram = meter.create_histogram(
+    'subprocess_max_rss', 'By', 'Peak resident set size of child process'
+)
+failures_counter = meter.create_counter(
+    'subprocess_failures', '1', 'Child processes which failed, timed out or were killed'
+)
+
+
+class ProcessLimits(BaseModel):
+    timeout: float | None = None  # wall-clock seconds
+    cpu_time: int | None = None  # CPU seconds, RLIMIT_CPU
+    memory: int | None = None  # bytes of address space, RLIMIT_AS
+
+
+class ProcessResult(BaseModel):
+    returncode: int
+    stdout: bytes = b''
+    cpu_time: float
+    max_rss: int  # bytes
+
+
+class ProcessError(RuntimeError):
+    def __init__(self, program: str, reason: str, stderr: bytes = b'') -> None:
+        self.program = program
+        self.reason = reason
+        self.stderr = stderr
+        message = f'{program} {reason}'
+        if stderr:
+            message += f':\n{stderr.decode(errors="replace")}'
+        super().__init__(message)
+
+
+def command(template: string.Template, **values: object) -> list[str]:
+    """
+    Splits command template into argv. Every argument is substituted on its own,
+    so values are never split or interpreted by shell
+    """
+    return [
+        string.Template(arg).substitute(values)
+        for arg in shlex.split(template.template)
+    ]
+
+
+async def open_pipe_reader(fd: int) -> tuple[asyncio.StreamReader, asyncio.BaseTransport]:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=PIPE_CHUNK_SIZE, loop=loop)
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader, loop=loop),
+        os.fdopen(fd, 'rb', buffering=0),
+    )
+    return reader, transport
+
+
+async def open_pipe_writer(fd: int) -> tuple[asyncio.StreamWriter, asyncio.BaseTransport]:
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(
+        lambda: asyncio.streams.FlowControlMixin(loop=loop),
+        os.fdopen(fd, 'wb', buffering=0),
+    )
+    return asyncio.StreamWriter(transport, protocol, None, loop), transport
+
+
+async def _wait4(pid: int) -> tuple[int, int, resource.struct_rusage]:
+    if not hasattr(os, 'pidfd_open'):
+        return await asyncio.to_thread(os.wait4, pid, 0)
+
+    loop = asyncio.get_running_loop()
+    pidfd = os.pidfd_open(pid)
+    try:
+        exited = loop.create_future()
+
+        def _on_exit() -> None:
+            if not exited.done():
+                exited.set_result(None)
+
+        loop.add_reader(pidfd, _on_exit)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+    return os.wait4(pid, 0)
+
+
+def _limits_argv(limits: ProcessLimits) -> list[str]:
+    """
+    Returns prlimit argv prefix, so limits are set before program is executed
+    """
+    options = []
+    if limits.cpu_time is not None:
+        options.append(f'--cpu={limits.cpu_time}:{limits.cpu_time + CPU_LIMIT_GRACE}')
+    if limits.memory is not None:
+        options.append(f'--as={limits.memory}')
+    return ['prlimit', *options] if options else []
+
+
+def _discard_spawned(
+        parent_fds: list[int], spawn: asyncio.Future[subprocess.Popen[bytes]]
+) -> None:
+    # Spawn of cancelled caller still runs in thread and holds child ends of pipes
+    for fd in parent_fds:
+        os.close(fd)
+    if not spawn.cancelled() and spawn.exception() is None:
+        popen = spawn.result()
+        popen.kill()
+        asyncio.get_running_loop().run_in_executor(None, popen.wait)
+
+
+class ExecProcess:
+    """
+    Child process executed directly from argv, without shell in between.
+    Resource limits and `wrapper`, e.g. nice, are applied by programs which
+    exec into it. It is killed once wall-clock timeout passes and reaped
+    with wait4, so CPU time and peak RSS of every process are recorded.
+    Failures are raised as ProcessError with the tail of process stderr
+    """
+
+    stdin: asyncio.StreamWriter | None = None
+    stdout: asyncio.StreamReader | None = None
+
+    def __init__(
+            self,
+            argv: Sequence[str],
+            limits: ProcessLimits | None = None,
+            wrapper: Sequence[str] = (),
+            pass_fds: Sequence[int] = (),
+            stdin: bool = False,
+            stdout: bool = False,
+    ) -> None:
+        self.program = os.path.basename(argv[0])
+        self.limits = limits or ProcessLimits()
+        self.argv = [*_limits_argv(self.limits), *wrapper, *argv]
+        self._pass_fds = tuple(pass_fds)
+        self._with_stdin = stdin
+        self._with_stdout = stdout
+
+        self._popen: subprocess.Popen[bytes] | None = None
+        self._transports: list[asyncio.BaseTransport] = []
+        self._stderr_tail = bytearray()
+        self._timed_out = False
+        self._timer: asyncio.TimerHandle | None = None
+
+    async def __aenter__(self) -> Self:
+        loop = asyncio.get_running_loop()
+        stdin_r, stdin_w = os.pipe() if self._with_stdin else (None, None)
+        stdout_r, stdout_w = os.pipe() if self._with_stdout else (None, None)
+        stderr_r, stderr_w = os.pipe()
+        parent_fds = [fd for fd in (stdin_w, stdout_r, stderr_r) if fd is not None]
+        # Fork and exec block, so process is spawned in thread
+        spawn = asyncio.ensure_future(
+            asyncio.to_thread(self._spawn, stdin_r, stdout_w, stderr_w)
+        )
+        try:
+            self._popen = await asyncio.shield(spawn)
+        except BaseException:
+            spawn.add_done_callback(partial(_discard_spawned, parent_fds))
+            raise
+
+        if self.limits.timeout is not None:
+            self._timer = loop.call_later(self.limits.timeout, self._kill_on_timeout)
+        self._exit = loop.create_task(self._reap(self._popen))
+
+        if stdin_w is not None:
+            self.stdin, transport = await open_pipe_writer(stdin_w)
+            self._transports.append(transport)
+        if stdout_r is not None:
+            self.stdout, transport = await open_pipe_reader(stdout_r)
+            self._transports.append(transport)
+        stderr, transport = await open_pipe_reader(stderr_r)
+        self._transports.append(transport)
+        self._stderr = loop.create_task(self._read_stderr(stderr))
+        return self
+
+    async def __aexit__(
+            self,
+            exc_type: type[BaseException] | None,
+            exc_val: BaseException | None,
+            exc_tb: TracebackType | None,
+    ) -> None:
+        if exc_type is not None:
+            self.kill()
+        try:
+            await asyncio.shield(self._exit)
+            await self._stderr
+        finally:
+            if self._timer is not None:
+                self._timer.cancel()
+            for transport in self._transports:
+                transport.close()
+
+    def _spawn(
+            self, stdin: int | None, stdout: int | None, stderr: int
+    ) -> subprocess.Popen[bytes]:
+        try:
+            return subprocess.Popen(
+                self.argv,
+                stdin=stdin if stdin is not None else subprocess.DEVNULL,
+                stdout=stdout if stdout is not None else subprocess.DEVNULL,
+                stderr=stderr,
+                pass_fds=self._pass_fds,
+            )
+        finally:
+            for fd in (stdin, stdout, stderr):
+                if fd is not None:
+                    os.close(fd)
+
+    async def _reap(self, popen: subprocess.Popen[bytes]) -> ProcessResult:
+        _, status, rusage = await _wait4(popen.pid)
+        # Process is reaped already, Popen must not wait for it on its own
+        popen.returncode = os.waitstatus_to_exitcode(status)
+        result = ProcessResult(
+            returncode=popen.returncode,
+            cpu_time=rusage.ru_utime + rusage.ru_stime,
+            max_rss=rusage.ru_maxrss * 1024,
+        )
+        cpu_time_histogram.record(result.cpu_time, {'program': self.program})
+        max_rss_histogram.record(result.max_rss, {'program': self.program})
+        return result
+
+    async def _read_stderr(self, stderr: asyncio.StreamReader) -> None:
+        while chunk := await stderr.read(PIPE_CHUNK_SIZE):
+            self._stderr_tail += chunk
+            del self._stderr_tail[:-STDERR_TAIL_SIZE]
+
+    def _kill_on_timeout(self) -> None:
+        self._timed_out = True
+        self.kill()
+
+    def kill(self) -> None:
+        # Until reaped, pid of exited process can't be reused
+        if self._popen is not None and not self._exit.done():
+            self._popen.send_signal(signal.SIGKILL)
+
+    async def wait(self, check: bool = True) -> ProcessResult:
+        """
+        Waits for process exit. Raises ProcessError if it was killed
+        or, when `check` is set, exited with non-zero code
+        """
+        result = await asyncio.shield(self._exit)
+        await self._stderr
+
+        if self._timed_out:
+            reason = f'timed out after {self.limits.timeout}s'
+        elif result.returncode < 0:
+            reason = f'killed by {signal.Signals(-result.returncode).name}'
+        elif check and result.returncode != 0:
+            reason = f'failed with code {result.returncode}'
+        else:
+            return result
+        failures_counter.add(1, {'program': self.program})
+        raise ProcessError(self.program, reason, bytes(self._stderr_tail))
+
+
+async def run_process(
+        argv: Sequence[str],
+        input: bytes | memoryview | None = None,
+        limits: ProcessLimits | None = None,
+        check: bool = True,
+) -> ProcessResult:
+    """
+    Runs process to completion, feeding `input` to its stdin and collecting stdout
+    """
+    async with ExecProcess(
+            argv, limits, stdin=input is not None, stdout=True
+    ) as proc:
+        assert proc.stdout
+
+        async def _write(data: bytes | memoryview) -> None:
+            assert proc.stdin
+            try:
+                proc.stdin.write(data)
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                proc.stdin.close()
+
+        async with asyncio.TaskGroup() as tg:
+            if input is not None:
+                tg.create_task(_write(input))
+            stdout = tg.create_task(proc.stdout.read())
+        result = await proc.wait(check=check)
+    return result.model_copy(update={'stdout': stdout.result()})
@@ -0,0 +1,128 @@
+import asyncio
+
+from tortoise.transactions import in_transaction
+
+from ossia.tracks.database.models import AudioRenditions, Tracks
+from ossia.tracks.enum import TrackStatus
+from ossia.tracks.services.encode import FFMpegEncoder
+from ossia.tracks.services.s3 import Buckets, S3Service
+from ossia.tracks.services.waveform import delete_waveform
+
+
+def renditions_key(track: Tracks) -> str:
+    """
+    Returns key stem under which audio renditions of the track are stored
+    """
+    if track.audio_key:
+        return track.audio_key
+    return FFMpegEncoder.encode_track_id(track.id).rstrip('=')
+
+
+def ready_renditions(track: Tracks) -> list[Buckets]:
+    """
+    Returns buckets with already published renditions of the track
+    """
+    if track.status == TrackStatus.READY and not track.renditions:
+        # Track was processed before renditions were tracked separately
+        return list(Buckets.rendition_buckets())
+    return [Buckets(bucket) for bucket in track.renditions]
+
+
+async def link_renditions(track_id: str, content_hash: str) -> bool:
+    """
+    Points track to already encoded renditions of the same source.
+    Returns False if there is nothing to link to
+    """
+    track_uuid = FFMpegEncoder.decode_track_id(track_id)
+    async with in_transaction():
+        renditions = (
+            await AudioRenditions.filter(content_hash=content_hash)
+            .select_for_update()
+            .get_or_none()
+        )
+        if renditions is None:
+            return False
+        track = await Tracks.filter(id=track_uuid).select_for_update().get_or_none()
+        if track is None:
+            return False
+        if track.content_hash == content_hash and track.audio_key == renditions.key:
+            # Message was redelivered after the track had been linked already
+            return True
+        renditions.ref_count += 1
+        await renditions.save(update_fields=['ref_count'])
+        await Tracks.filter(id=track_uuid).update(
+            audio_key=renditions.key,
+            renditions=renditions.renditions or list(Buckets.rendition_buckets()),
+            content_hash=content_hash,
+            duration=renditions.duration,
+            integrated_loudness=renditions.integrated_loudness,
+            loudness_range=renditions.loudness_range,
+            true_peak=renditions.true_peak,
+            status=TrackStatus.READY,
+        )
+    return True
+
+
+async def register_renditions(track_id: str, content_hash: str) -> None:
+    """
+    Adds freshly encoded renditions of the track to the index
+    """
+    track_uuid = FFMpegEncoder.decode_track_id(track_id)
+    async with in_transaction():
+        track = await Tracks.get(id=track_uuid)
+        track.content_hash = content_hash
+        await track.save(update_fields=['content_hash'])
+        # If same source was encoded concurrently by another worker, this track
+        # keeps its own renditions: they are neither shared nor counted
+        await AudioRenditions.get_or_create(
+            content_hash=content_hash,
+            defaults={
+                'key': renditions_key(track),
+                'duration': track.duration,
+                'renditions': track.renditions,
+                'integrated_loudness': track.integrated_loudness,
+                'loudness_range': track.loudness_range,
+                'true_peak': track.true_peak,
+                'ref_count': 1,
+            },
+        )
+
+
+async def _delete_objects(key: str) -> None:
+    buckets = *Buckets.rendition_buckets(), *Buckets.opus_buckets()
+    async with S3Service() as s3:
+        await asyncio.gather(
+            *[
+                s3.delete_object(Bucket=bucket, Key=f'{key}.{bucket.extension}')
+                for bucket in buckets
+            ],
+            delete_waveform(s3, key),
+        )
+
+
+async def release_renditions(track: Tracks) -> None:
+    """
+    Drops track reference to its renditions, deletes them when unused
+    """
+    key = renditions_key(track)
+    if track.content_hash is None:
+        await _delete_objects(key)
+        return
+
+    async with in_transaction():
+        renditions = (
+            await AudioRenditions.filter(content_hash=track.content_hash)
+            .select_for_update()
+            .get_or_none()
+        )
+        if renditions is None or renditions.key != key:
+            unused = True
+        else:
+            renditions.ref_count -= 1
+            unused = renditions.ref_count <= 0
+            if unused:
+                await renditions.delete()
+            else:
+                await renditions.save(update_fields=['ref_count'])
+    if unused:
+        await _delete_objects(key)
@@ -1,19 +1,36 @@
+import asyncio
 import enum
+import typing
+from collections.abc import AsyncIterable, Iterable
+from contextlib import AsyncExitStack
 from types import TracebackType
 
 import aioboto3
+from aiobotocore.config import AioConfig
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
 
 try:
     from types_aiobotocore_s3 import S3Client
 except ImportError:
-    import typing
-
     # In prod env we don't install any types packages, so
     type S3Client = typing.Any  # type: ignore[no-redef]
 
 from ossia.tracks.config import TracksServiceConfig
 
 config = TracksServiceConfig()
+meter = metrics.get_meter(__name__)
+
+PART_SIZE = 8 * 1024 * 1024  # 8 MB, S3 requires at least 5 MB for non-last parts
+CLIENT_CONFIG = AioConfig(
+    # Presigned URLs are signed with SigV2 by default
+    signature_version='s3v4',
+    max_pool_connections=config.s3_pool_size,
+    connect_timeout=config.s3_connect_timeout,
+    read_timeout=config.s3_read_timeout,
+    tcp_keepalive=True,
+    connector_args={'keepalive_timeout': config.s3_keepalive_timeout},
+)
 
 
 class Buckets(enum.StrEnum):
@@ -23,12 +40,39 @@ class Buckets(enum.StrEnum):
     OGG_96 = 'ogg96'
     OGG_160 = 'ogg160'
     OGG_320 = 'ogg320'
+    OPUS_64 = 'opus64'
+    OPUS_96 = 'opus96'
+    OPUS_160 = 'opus160'
+    WAVEFORMS = 'waveforms'
+    ARCHIVES = 'archives'
     LOGS = 'logs'
 
     @classmethod
     def ogg_buckets(cls) -> tuple['Buckets', 'Buckets', 'Buckets']:
         return cls.OGG_96, cls.OGG_160, cls.OGG_320
 
+    @classmethod
+    def opus_buckets(cls) -> tuple['Buckets', 'Buckets', 'Buckets']:
+        return cls.OPUS_64, cls.OPUS_96, cls.OPUS_160
+
+    @classmethod
+    def rendition_buckets(cls) -> tuple['Buckets', ...]:
+        """
+        Renditions every processed track has, Opus ones are optional
+        """
+        return *cls.ogg_buckets(), cls.RAW_TRACKS
+
+    @property
+    def extension(self) -> str:
+        """
+        Extension of audio objects in rendition bucket
+        """
+        if self == Buckets.RAW_TRACKS:
+            return 'flac'
+        if self in Buckets.opus_buckets():
+            return 'opus'
+        return 'ogg'
+
     @classmethod
     def all_buckets(cls) -> tuple['Buckets', ...]:
         return (
@@ -38,23 +82,140 @@ class Buckets(enum.StrEnum):
             cls.OGG_96,
             cls.OGG_160,
             cls.OGG_320,
+            cls.OPUS_64,
+            cls.OPUS_96,
+            cls.OPUS_160,
+            cls.WAVEFORMS,
+            cls.ARCHIVES,
             cls.LOGS,
         )
 
 
-class S3Service:
-    client: S3Client | None = None
+def _session() -> aioboto3.Session:
+    return aioboto3.Session(
+        aws_access_key_id=config.s3_access_key,
+        aws_secret_access_key=config.s3_secret_key,
+    )
+
+
+class S3Pool:
+    """
+    S3 clients kept open for the whole process lifetime, one per endpoint,
+    so connections are reused by every request and task instead of being
+    set up for each of them. Started by both FastAPI lifespan and broker
+    startup, it is closed once both of them stop
+    """
 
     def __init__(self) -> None:
-        self.endpoint_url = config.s3_url
-        self.session = aioboto3.Session(
-            aws_access_key_id=config.s3_access_key,
-            aws_secret_access_key=config.s3_secret_key,
+        self._users = 0
+        self._stack: AsyncExitStack | None = None
+        self._session: aioboto3.Session | None = None
+        self._clients: dict[str, S3Client] = {}
+        self._lock = asyncio.Lock()
+
+        meter.create_observable_gauge(
+            's3_pool_connections',
+            callbacks=[self._observe_connections],
+            unit='1',
+            description='Connections of S3 client pool, by state',
         )
+        meter.create_observable_gauge(
+            's3_pool_utilisation',
+            callbacks=[self._observe_utilisation],
+            unit='1',
+            description='Share of S3 client pool connections in use',
+        )
+
+    @property
+    def started(self) -> bool:
+        return self._stack is not None
+
+    async def start(self) -> None:
+        self._users += 1
+        if self._stack is None:
+            self._stack = AsyncExitStack()
+            self._session = _session()
+
+    async def stop(self) -> None:
+        self._users -= 1
+        if self._users == 0 and self._stack is not None:
+            stack, self._stack = self._stack, None
+            self._clients.clear()
+            await stack.aclose()
+
+    async def client(self, endpoint_url: str) -> S3Client:
+        assert self._stack and self._session, 'S3 client pool is not started'
+        if client := self._clients.get(endpoint_url):
+            return client
+        async with self._lock:
+            if endpoint_url not in self._clients:
+                self._clients[endpoint_url] = await self._stack.enter_async_context(
+                    self._session.client(
+                        's3', endpoint_url=endpoint_url, config=CLIENT_CONFIG
+                    )
+                )
+        return self._clients[endpoint_url]
+
+    def _connector_stats(self) -> list[tuple[int, int, int]]:
+        """
+        Returns (in use, idle, limit) connections of every pool connector.
+        They are read from aiobotocore and aiohttp internals by exporter thread,
+        so nothing is observed if those change or are being torn down
+        """
+        stats = []
+        try:
+            for client in list(self._clients.values()):
+                endpoint = getattr(client, '_endpoint', None)
+                http_session = getattr(endpoint, 'http_session', None)
+                # aiobotocore keeps one aiohttp session per proxy
+                for session in list(getattr(http_session, '_sessions', {}).values()):
+                    connector = getattr(session, 'connector', None)
+                    if connector is None:
+                        continue
+                    idle = list(getattr(connector, '_conns', {}).values())
+                    stats.append(
+                        (
+                            len(getattr(connector, '_acquired', ())),
+                            sum(len(conns) for conns in idle),
+                            getattr(connector, 'limit', 0),
+                        )
+                    )
+        except Exception:
+            return []
+        return stats
+
+    def _observe_connections(self, options: CallbackOptions) -> Iterable[Observation]:
+        stats = self._connector_stats()
+        if stats:
+            in_use = sum(in_use for in_use, _, _ in stats)
+            yield Observation(in_use, {'state': 'in_use'})
+            yield Observation(sum(idle for _, idle, _ in stats), {'state': 'idle'})
+
+    def _observe_utilisation(self, options: CallbackOptions) -> Iterable[Observation]:
+        for in_use, _, limit in self._connector_stats():
+            if limit:
+                yield Observation(in_use / limit)
+
+
+s3_pool = S3Pool()
+
+
+class S3Service:
+    """
+    Gives out pooled client while the pool is started.
+    Otherwise, e.g. in scripts, client is created for this use only
+    """
+
+    client: S3Client | None = None
+
+    def __init__(self, endpoint_url: str | None = None) -> None:
+        self.endpoint_url = endpoint_url or config.s3_url
 
     async def __aenter__(self) -> S3Client:
-        self.client: S3Client = self.session.client(
-            's3', endpoint_url=self.endpoint_url
+        if s3_pool.started:
+            return await s3_pool.client(self.endpoint_url)
+        self.client: S3Client = _session().client(
+            's3', endpoint_url=self.endpoint_url, config=CLIENT_CONFIG
         )  # type: ignore[assignment]
         if not self.client:
             raise ConnectionError('Cannot connect to S3')
@@ -69,3 +230,98 @@ class S3Service:
         if self.client:
             await self.client.__aexit__(exc_type, exc_val, exc_tb)
             self.client = None
+
+
+class MultipartUpload:
+    """
+    Buffered writer into S3 multipart upload.
+    Keeps at most one part in memory, so writers are throttled by S3 speed
+    """
+
+    upload_id: str | None = None
+
+    def __init__(
+            self, client: S3Client, bucket: str, key: str, part_size: int = PART_SIZE
+    ) -> None:
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.parts: list[dict[str, typing.Any]] = []
+        self._buffer = bytearray()
+
+    async def start(self) -> None:
+        res = await self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key
+        )
+        self.upload_id = res['UploadId']
+
+    async def _upload_part(self, data: bytes) -> None:
+        assert self.upload_id, 'Multipart upload is not started'
+        number = len(self.parts) + 1
+        res = await self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        self.parts.append({'ETag': res['ETag'], 'PartNumber': number})
+
+    async def write(self, data: bytes) -> None:
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            await self._upload_part(part)
+
+    async def complete(self) -> str:
+        """
+        Uploads buffered data and completes upload, returns ETag of the object
+        """
+        if self._buffer or not self.parts:
+            await self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+        res = await self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,  # type: ignore[arg-type]
+            MultipartUpload={'Parts': self.parts},  # type: ignore[typeddict-item]
+        )
+        return res['ETag']
+
+    async def abort(self) -> None:
+        if self.upload_id is None:
+            return
+        await self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+        self._buffer.clear()
+
+
+async def presign_object(bucket: str, key: str, media_type: str | None = None) -> str:
+    """
+    Returns short-lived URL to get object straight from S3.
+    It is signed for public S3 endpoint, when one is configured
+    """
+    params = {'Bucket': bucket, 'Key': key}
+    if media_type is not None:
+        params['ResponseContentType'] = media_type
+    async with S3Service(config.s3_public_url) as s3:
+        return await s3.generate_presigned_url(
+            'get_object', Params=params, ExpiresIn=config.presigned_url_ttl
+        )
+
+
+async def upload_chunks(
+        client: S3Client, chunks: AsyncIterable[bytes], bucket: str, key: str
+) -> None:
+    upload = MultipartUpload(client, bucket, key)
+    await upload.start()
+    try:
+        async for chunk in chunks:
+            await upload.write(chunk)
+        await upload.complete()
+    except BaseException:
+        await upload.abort()
+        raise
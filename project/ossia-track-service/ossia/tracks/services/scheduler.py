@@ -0,0 +1,141 @@
+import asyncio
+import os
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Iterable
+from contextlib import asynccontextmanager
+
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+
+from ossia.tracks.config import TracksServiceConfig
+
+meter = metrics.get_meter(__name__)
+
+queue_depth = meter.create_up_down_counter(
+    'encode_queue_depth', '1', 'Amount of encode jobs waiting for a slot'
+)
+slots_in_use = meter.create_up_down_counter(
+    'encode_slots_in_use', '1', 'Amount of encode slots taken by running jobs'
+)
+wait_duration = meter.create_histogram(
+    'encode_slot_wait_ms', 'ms', 'Time spent by encode jobs waiting for a slot'
+)
+
+
+class EncodeScheduler:
+    """
+    FIFO pool of encode slots shared by every ffmpeg process of the worker.
+    Each job takes as many slots as CPU-bound encoders it runs
+    """
+
+    def __init__(
+            self,
+            slots: int,
+            niceness: int = 0,
+            cpu_affinity: Iterable[int] | None = None,
+    ) -> None:
+        if slots < 1:
+            raise ValueError('At least one encode slot is required')
+        self.slots = slots
+        self.niceness = niceness
+        self.cpu_affinity = set(cpu_affinity) if cpu_affinity else None
+        self._free = slots
+        self._waiters: deque[tuple[int, asyncio.Future[None]]] = deque()
+
+        meter.create_observable_gauge(
+            'encode_slots_utilisation',
+            callbacks=[self._observe_utilisation],
+            unit='1',
+            description='Share of encode slots taken by running jobs',
+        )
+
+    @classmethod
+    def from_config(cls, config: TracksServiceConfig) -> 'EncodeScheduler':
+        if config.encode_cpu_affinity:
+            cores = len(config.encode_cpu_affinity)
+        elif hasattr(os, 'sched_getaffinity'):
+            cores = len(os.sched_getaffinity(0))
+        else:
+            cores = os.cpu_count() or 1
+        return cls(
+            slots=config.encode_slots or cores,
+            niceness=config.encode_niceness,
+            cpu_affinity=config.encode_cpu_affinity,
+        )
+
+    @property
+    def used(self) -> int:
+        return self.slots - self._free
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _observe_utilisation(
+            self, options: CallbackOptions
+    ) -> Iterable[Observation]:
+        yield Observation(self.used / self.slots)
+
+    def _wake_up(self) -> None:
+        while self._waiters:
+            weight, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if weight > self._free:
+                return
+            self._waiters.popleft()
+            self._free -= weight
+            future.set_result(None)
+
+    async def _acquire(self, weight: int) -> None:
+        if not self._waiters and weight <= self._free:
+            self._free -= weight
+            return
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiters.append((weight, future))
+        queue_depth.add(1)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(weight)
+            self._wake_up()
+            raise
+        finally:
+            queue_depth.add(-1)
+
+    def _release(self, weight: int) -> None:
+        self._free += weight
+        self._wake_up()
+
+    @asynccontextmanager
+    async def slot(self, weight: int = 1) -> AsyncIterator[None]:
+        weight = max(1, min(weight, self.slots))
+        start_time = time.perf_counter()
+        await self._acquire(weight)
+        wait_duration.record((time.perf_counter() - start_time) * 1000)
+        slots_in_use.add(weight)
+        try:
+            yield
+        finally:
+            slots_in_use.add(-weight)
+            self._release(weight)
+
+    def wrapper(self) -> list[str]:
+        """
+        Returns argv prefix which sets niceness and CPU affinity of encoder
+        before it is executed, so every thread it starts inherits them
+        """
+        argv = []
+        if self.niceness:
+            argv += ['nice', '-n', str(self.niceness)]
+        if self.cpu_affinity:
+            cpus = ','.join(map(str, sorted(self.cpu_affinity)))
+            argv += ['taskset', '--cpu-list', cpus]
+        return argv
+
+
+scheduler = EncodeScheduler.from_config(TracksServiceConfig())
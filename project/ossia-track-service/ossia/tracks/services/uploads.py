@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from botocore.exceptions import ClientError
+from tortoise import timezone
+
+from ossia.tracks.config import TracksServiceConfig
+from ossia.tracks.database.models import UploadSessions
+from ossia.tracks.services.s3 import Buckets, S3Client, S3Service
+
+config = TracksServiceConfig()
+logger = logging.getLogger(__name__)
+
+
+def upload_expiry() -> datetime:
+    """
+    Returns creation time of the oldest upload session which isn't abandoned
+    """
+    return timezone.now() - timedelta(seconds=config.upload_session_ttl)
+
+
+async def abort_upload_session(s3: S3Client, session: UploadSessions) -> None:
+    try:
+        await s3.abort_multipart_upload(
+            Bucket=Buckets.BUFFER, Key=session.audio_key, UploadId=session.s3_upload_id
+        )
+    except ClientError as e:
+        # Upload may be aborted already by cleanup of another worker
+        if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+            raise
+    await session.delete()
+
+
+async def expire_upload_sessions() -> None:
+    """
+    Aborts multipart uploads of abandoned sessions, so their parts
+    stop taking space in BUFFER bucket, and deletes the sessions
+    """
+    sessions = await UploadSessions.filter(created_at__lt=upload_expiry())
+    if not sessions:
+        return
+    async with S3Service() as s3:
+        for session in sessions:
+            await abort_upload_session(s3, session)
+
+
+async def run_upload_cleanup() -> None:
+    while True:
+        try:
+            await expire_upload_sessions()
+        except Exception:
+            logger.exception('Failed to expire upload sessions')
+        await asyncio.sleep(config.upload_cleanup_interval)
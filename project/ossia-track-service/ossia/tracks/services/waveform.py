@@ -0,0 +1,87 @@
+import asyncio
+
+import numpy as np
+import numpy.typing as npt
+
+from ossia.tracks.services.s3 import Buckets, S3Client
+
+PEAKS_BLOCK = 256  # PCM frames per finest peak
+WAVEFORM_RESOLUTIONS = (256, 512, 1024, 2048, 4096)
+
+Peaks = npt.NDArray[np.int16]
+
+
+class PeaksAccumulator:
+    """
+    Collects min/max values of mono s16le PCM stream per block of frames,
+    so whole decoded track is never kept in memory
+    """
+
+    def __init__(self, block: int = PEAKS_BLOCK) -> None:
+        self.block = block
+        self._tail = b''
+        self._mins: list[Peaks] = []
+        self._maxs: list[Peaks] = []
+
+    def _add(self, frames: Peaks) -> None:
+        self._mins.append(frames.min(axis=1))
+        self._maxs.append(frames.max(axis=1))
+
+    def feed(self, data: bytes) -> None:
+        data = self._tail + data
+        size = len(data) // (self.block * 2) * self.block * 2
+        self._tail = data[size:]
+        if size:
+            frames = np.frombuffer(data, dtype='<i2', count=size // 2)
+            self._add(frames.reshape(-1, self.block))
+
+    def finish(self) -> tuple[Peaks, Peaks]:
+        if len(self._tail) >= 2:
+            frames = np.frombuffer(self._tail, dtype='<i2', count=len(self._tail) // 2)
+            self._add(frames.reshape(1, -1))
+            self._tail = b''
+        if not self._mins:
+            return np.zeros(0, np.int16), np.zeros(0, np.int16)
+        return np.concatenate(self._mins), np.concatenate(self._maxs)
+
+
+def downsample(mins: Peaks, maxs: Peaks, resolution: int) -> bytes:
+    """
+    Reduces block peaks to given amount of points.
+    Returns interleaved int8 min/max pairs
+    """
+    peaks = np.zeros((resolution, 2), dtype=np.int8)
+    if len(mins):
+        starts = np.arange(resolution) * len(mins) // resolution
+        peaks[:, 0] = np.minimum.reduceat(mins, starts) >> 8
+        peaks[:, 1] = np.maximum.reduceat(maxs, starts) >> 8
+    return peaks.tobytes()
+
+
+def waveform_key(key: str, resolution: int) -> str:
+    return f'{key}/{resolution}.peaks'
+
+
+async def upload_waveform(s3: S3Client, key: str, mins: Peaks, maxs: Peaks) -> None:
+    await asyncio.gather(
+        *[
+            s3.put_object(
+                Bucket=Buckets.WAVEFORMS,
+                Key=waveform_key(key, resolution),
+                Body=downsample(mins, maxs, resolution),
+                ContentType='application/octet-stream',
+            )
+            for resolution in WAVEFORM_RESOLUTIONS
+        ]
+    )
+
+
+async def delete_waveform(s3: S3Client, key: str) -> None:
+    await asyncio.gather(
+        *[
+            s3.delete_object(
+                Bucket=Buckets.WAVEFORMS, Key=waveform_key(key, resolution)
+            )
+            for resolution in WAVEFORM_RESOLUTIONS
+        ]
+    )
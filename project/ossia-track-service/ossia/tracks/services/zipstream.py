@@ -0,0 +1,290 @@
+import struct
+import zlib
+from collections.abc import (
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Sequence,
+)
+from contextlib import aclosing
+from datetime import datetime
+
+from pydantic import BaseModel
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_ENTRIES_LIMIT = 0xFFFF
+ZIP64_VERSION = 45
+ZIP32_VERSION = 20
+# Sizes and CRC follow data in descriptor, names are UTF-8
+FLAGS = 0x0008 | 0x0800
+STORED = 0
+UNIX_FILE_ATTRS = (0o100644 & 0xFFFF) << 16
+VERSION_MADE_BY = 3 << 8 | ZIP64_VERSION  # Unix
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+ZIP64_EXTRA_HEADER = struct.Struct('<HH')
+END_RECORD64 = struct.Struct('<IQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<IIQI')
+END_RECORD = struct.Struct('<IHHHHIIH')
+
+
+class ZipEntry(BaseModel):
+    name: str
+    size: int
+    modified: datetime
+    crc: int | None = None
+
+    @property
+    def zip64(self) -> bool:
+        return self.size >= ZIP32_LIMIT
+
+
+class ObjectRead(BaseModel):
+    index: int  # of archive entry
+    start: int
+    end: int  # exclusive
+
+
+def _dos_datetime(moment: datetime) -> tuple[int, int]:
+    time = moment.hour << 11 | moment.minute << 5 | moment.second // 2
+    date = (moment.year - 1980) << 9 | moment.month << 5 | moment.day
+    return time, date
+
+
+def _local_header(entry: ZipEntry) -> bytes:
+    name = entry.name.encode()
+    extra = b''
+    size = 0
+    if entry.zip64:
+        # Real sizes are in data descriptor, this only announces 8-byte ones
+        extra = ZIP64_EXTRA_HEADER.pack(0x0001, 16) + struct.pack('<QQ', 0, 0)
+        size = ZIP32_LIMIT
+    return (
+        LOCAL_HEADER.pack(
+            0x04034B50,
+            ZIP64_VERSION if entry.zip64 else ZIP32_VERSION,
+            FLAGS,
+            STORED,
+            *_dos_datetime(entry.modified),
+            0,
+            size,
+            size,
+            len(name),
+            len(extra),
+        )
+        + name
+        + extra
+    )
+
+
+def _data_descriptor(entry: ZipEntry) -> bytes:
+    descriptor = DATA_DESCRIPTOR64 if entry.zip64 else DATA_DESCRIPTOR
+    return descriptor.pack(0x08074B50, entry.crc or 0, entry.size, entry.size)
+
+
+def _central_header(entry: ZipEntry, offset: int) -> bytes:
+    # Fields which don't fit are moved to ZIP64 extra field in fixed order
+    name = entry.name.encode()
+    zip64_fields = []
+    size = entry.size
+    if size >= ZIP32_LIMIT:
+        zip64_fields += [size, size]
+        size = ZIP32_LIMIT
+    if offset >= ZIP32_LIMIT:
+        zip64_fields.append(offset)
+        offset = ZIP32_LIMIT
+    extra = b''
+    if zip64_fields:
+        extra = ZIP64_EXTRA_HEADER.pack(0x0001, 8 * len(zip64_fields))
+        extra += struct.pack(f'<{len(zip64_fields)}Q', *zip64_fields)
+    return (
+        CENTRAL_HEADER.pack(
+            0x02014B50,
+            VERSION_MADE_BY,
+            ZIP64_VERSION if entry.zip64 or zip64_fields else ZIP32_VERSION,
+            FLAGS,
+            STORED,
+            *_dos_datetime(entry.modified),
+            entry.crc or 0,
+            size,
+            size,
+            len(name),
+            len(extra),
+            0,
+            0,
+            0,
+            UNIX_FILE_ATTRS,
+            offset,
+        )
+        + name
+        + extra
+    )
+
+
+def _end_records(entries: int, offset: int, size: int) -> bytes:
+    records = b''
+    if (
+            entries >= ZIP32_ENTRIES_LIMIT
+            or offset >= ZIP32_LIMIT
+            or size >= ZIP32_LIMIT
+    ):
+        end64_offset = offset + size
+        records += END_RECORD64.pack(
+            0x06064B50,
+            END_RECORD64.size - 12,
+            VERSION_MADE_BY,
+            ZIP64_VERSION,
+            0,
+            0,
+            entries,
+            entries,
+            size,
+            offset,
+        )
+        records += END_LOCATOR64.pack(0x07064B50, 0, end64_offset, 1)
+        entries = min(entries, ZIP32_ENTRIES_LIMIT)
+        offset = min(offset, ZIP32_LIMIT)
+        size = min(size, ZIP32_LIMIT)
+    return records + END_RECORD.pack(
+        0x06054B50, 0, 0, entries, entries, size, offset, 0
+    )
+
+
+def _window(data: bytes, offset: int, start: int, end: int) -> bytes:
+    """
+    Returns part of `data` located at `offset` which falls into [start, end)
+    """
+    if offset >= start and offset + len(data) <= end:
+        return data
+    return data[max(start - offset, 0): max(end - offset, 0)]
+
+
+class ZipArchive:
+    """
+    Layout of STORED archive of entries with known sizes. CRC is written
+    into data descriptors and is the only value unknown before entry is read,
+    so every byte offset is known up front and any byte range can be streamed
+    """
+
+    def __init__(self, entries: Sequence[ZipEntry]) -> None:
+        self.entries = list(entries)
+        self._offsets: list[int] = []
+        offset = 0
+        for entry in self.entries:
+            if entry.size == 0:
+                entry.crc = 0
+            self._offsets.append(offset)
+            offset += (
+                len(_local_header(entry))
+                + entry.size
+                + len(_data_descriptor(entry))
+            )
+        self._central_offset = offset
+        # CRC values don't change lengths of any records
+        central_size = sum(
+            len(_central_header(entry, offset))
+            for entry, offset in zip(self.entries, self._offsets)
+        )
+        self.size = (
+            self._central_offset
+            + central_size
+            + len(
+                _end_records(len(self.entries), self._central_offset, central_size)
+            )
+        )
+
+    def _data_span(self, index: int) -> tuple[int, int]:
+        entry = self.entries[index]
+        start = self._offsets[index] + len(_local_header(entry))
+        return start, start + entry.size
+
+    def reads(self, start: int, end: int) -> list[ObjectRead]:
+        """
+        Returns ranges of entry objects needed to stream archive bytes [start, end).
+        Entries with unknown CRC are read whole if their CRC falls into the range
+        """
+        reads = []
+        for index, entry in enumerate(self.entries):
+            if self._offsets[index] >= end:
+                break
+            data_start, data_end = self._data_span(index)
+            descriptor_end = data_end + len(_data_descriptor(entry))
+            needs_crc = entry.crc is None and (
+                    (start < descriptor_end and end > data_end)
+                    or end > self._central_offset
+            )
+            if needs_crc:
+                reads.append(ObjectRead(index=index, start=0, end=entry.size))
+            elif max(start, data_start) < min(end, data_end):
+                reads.append(
+                    ObjectRead(
+                        index=index,
+                        start=max(start, data_start) - data_start,
+                        end=min(end, data_end) - data_start,
+                    )
+                )
+        return reads
+
+    async def stream(
+            self,
+            read_objects: Callable[
+                [list[ObjectRead]], AsyncGenerator[AsyncIterator[bytes], None]
+            ],
+            start: int = 0,
+            end: int | None = None,
+            on_checksum: Callable[[int, int], Awaitable[None]] | None = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Streams archive bytes [start, end). `read_objects` yields bodies of
+        given object ranges in their order. `on_checksum` is called with
+        entry index and CRC once it is computed for the first time
+        """
+        end = self.size if end is None else end
+        reads = self.reads(start, end)
+        async with aclosing(read_objects(list(reads))) as bodies:
+            pending = list(reversed(reads))
+            for index, entry in enumerate(self.entries):
+                offset = self._offsets[index]
+                if offset >= end:
+                    break
+                if header := _window(_local_header(entry), offset, start, end):
+                    yield header
+
+                data_start, data_end = self._data_span(index)
+                if pending and pending[-1].index == index:
+                    read = pending.pop()
+                    whole = read.start == 0 and read.end == entry.size
+                    crc = 0
+                    position = data_start + read.start
+                    async for chunk in await anext(bodies):
+                        if whole:
+                            crc = zlib.crc32(chunk, crc)
+                        if part := _window(chunk, position, start, end):
+                            yield part
+                        position += len(chunk)
+                    if position != data_start + read.end:
+                        raise ValueError(f'{entry.name} size has changed')
+                    if whole:
+                        if entry.crc is not None and entry.crc != crc:
+                            raise ValueError(f'{entry.name} content has changed')
+                        if entry.crc is None and on_checksum is not None:
+                            await on_checksum(index, crc)
+                        entry.crc = crc
+
+                descriptor = _window(_data_descriptor(entry), data_end, start, end)
+                if descriptor:
+                    yield descriptor
+
+        if end > self._central_offset:
+            central_directory = b''.join(
+                _central_header(entry, offset)
+                for entry, offset in zip(self.entries, self._offsets)
+            )
+            tail = central_directory + _end_records(
+                len(self.entries), self._central_offset, len(central_directory)
+            )
+            yield _window(tail, self._central_offset, start, end)